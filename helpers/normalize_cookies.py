@@ -0,0 +1,19 @@
+import json
+
+COOKIES_PATH = "data/cookies.json"
+VALID_SAME_SITE = ("Strict", "Lax", "None")
+
+def main():
+    # Cookie-Editor exports sameSite values Playwright rejects (e.g. "no_restriction")
+    with open(COOKIES_PATH, "r", encoding="utf-8") as f:
+        cookies = json.load(f)
+    for cookie in cookies:
+        if "sameSite" in cookie and cookie["sameSite"] not in VALID_SAME_SITE:
+            cookie["sameSite"] = "Lax"
+    with open(COOKIES_PATH, "w", encoding="utf-8") as f:
+        json.dump(cookies, f)
+    # Compact JSON, ready to paste into the COOKIES_JSON variable
+    print(json.dumps(cookies, separators=(",", ":")))
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,29 @@
 ﻿# discord_notifier.py
 import os
+import functools
+from types import MappingProxyType
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Parsed files are cached per (path, mtime), so an unchanged file is only read once
+@functools.lru_cache(maxsize=8)
+def _parse_variables(path, mtime_ns):
+    variables = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if "=" in line:
+                key, value = line.strip().split("=", 1)
+                variables[key] = value
+    return MappingProxyType(variables)
 
 # Load variables from file
 def load_variables(path="data/variables.txt"):
-    variables = {}
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            for line in f:
-                if "=" in line:
-                    key, value = line.strip().split("=", 1)
-                    variables[key] = value
-    return variables
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+    return _parse_variables(path, mtime_ns)
 
 def get_webhook_url():
     # Prefer environment variable, fallback to variables.txt
@@ -24,6 +36,23 @@ def get_webhook_url():
 
 WEBHOOK_URL = get_webhook_url()
 
+# One keep-alive session for every notification, so only the first POST pays the TLS handshake
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    # A webhook POST isn't idempotent: only retry when Discord can't have posted
+    # the message yet (connection failures, 429 with Retry-After), never after
+    # a read error or 5xx, which could post it twice
+    max_retries=Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.3,
+        status_forcelist=[429],
+        allowed_methods=["POST"],
+    ),
+))
+
 def notify_discord(event_type: str, listing_url: str, extra: str = ""):
     if not WEBHOOK_URL:
         print("[Discord] No webhook URL found, skipping notification.")
@@ -46,7 +75,7 @@ def notify_discord(event_type: str, listing_url: str, extra: str = ""):
     content = messages[event_type]
 
     try:
-        response = requests.post(WEBHOOK_URL, json={"content": content})
+        response = _SESSION.post(WEBHOOK_URL, json={"content": content}, timeout=5)
         if response.status_code == 204:
             print(f"[Discord] Notification sent: {event_type}")
             return True
@@ -1,25 +1,35 @@
-﻿import os
+﻿from __future__ import annotations
+
+import os
 import time
-import json
+import atexit
+import asyncio
+import functools
 import base64
 import re
 import urllib.parse
-from typing import List, Optional, Tuple, Dict
-from urllib.parse import urlparse
+from html import unescape
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+from typing import TYPE_CHECKING, List, Optional, Tuple, Dict, Mapping, Pattern
 
 # ---- Gmail imports ----
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
 from googleapiclient.errors import HttpError
 
-from bs4 import BeautifulSoup
-from playwright.sync_api import sync_playwright, Page, TimeoutError as PWTimeoutError
+import orjson
+import requests
 from .discord_notifier import notify_discord
 from .term_detector import is_short_term_heuristic
 
+# Playwright, lxml and the OAuth consent flow are imported where they are used,
+# keeping them out of the import-time cost of the module
+if TYPE_CHECKING:
+    from playwright.async_api import BrowserContext, Page
+
 # =========================
 # CONFIG DEFAULTS
 # =========================
@@ -29,27 +39,129 @@ VARIABLES_FILE = os.getenv("VARIABLES_FILE", "data/variables.txt")
 CREDENTIALS_JSON_PATH = os.getenv("CREDENTIALS_JSON_PATH", "data/credentials.json")
 TOKEN_JSON_PATH = os.getenv("TOKEN_JSON_PATH", "data/token.json")
 COOKIES_JSON_PATH = os.getenv("COOKIES_JSON_PATH", "data/cookies.json")
+PROCESSED_URLS_PATH = os.getenv("PROCESSED_URLS_PATH", "data/processed_urls.json")
+# Browser session (cookies + localStorage) saved after each contacted listing
+# and reused on the next start instead of injecting the cookies again
+STORAGE_STATE_PATH = os.getenv("STORAGE_STATE_PATH", "data/storage_state.json")
 
 # Gmail scopes:
 # - readonly: read messages
 # - modify: (optional) mark processed messages as read
 GMAIL_SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
 
+# Partial-response mask for messages.get: only the MIME types and body data
+# _message_html reads (three multipart levels deep), so headers and metadata
+# are not downloaded
+_PART_FIELDS = "mimeType,body/data"
+GMAIL_MESSAGE_FIELDS = (
+    f"payload({_PART_FIELDS},parts({_PART_FIELDS},parts({_PART_FIELDS},parts({_PART_FIELDS}))))"
+)
+# Unread BoligPortal emails handled per pass; a full page means more may be waiting
+GMAIL_LIST_PAGE_SIZE = 10
+# Gmail accepts at most 100 calls per batch and advises staying at or below 50
+GMAIL_BATCH_SIZE = 50
+# Refresh the access token this long before it expires (tokens live ~1 hour)
+GMAIL_TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
 # Polling interval to check Gmail (in seconds)
 POLL_SECONDS = int(os.getenv("POLL_SECONDS", "20"))
 
+# Optional Gmail push notifications (users.watch → Pub/Sub). When both are set,
+# the bot waits on the subscription instead of sleeping POLL_SECONDS.
+#   GMAIL_PUBSUB_TOPIC:        projects/<project>/topics/<topic>
+#   GMAIL_PUBSUB_SUBSCRIPTION: projects/<project>/subscriptions/<subscription>
+GMAIL_PUBSUB_TOPIC = os.getenv("GMAIL_PUBSUB_TOPIC")
+GMAIL_PUBSUB_SUBSCRIPTION = os.getenv("GMAIL_PUBSUB_SUBSCRIPTION")
+# Upper bound on one wait for a push, so a lost notification is still picked up
+GMAIL_PUSH_MAX_WAIT_SECONDS = 300
+# Renew users.watch this long before it expires (Gmail expires it after ~7 days)
+GMAIL_WATCH_RENEW_MARGIN_SECONDS = 3600
+
+# How many handled listing URLs to remember (oldest are dropped first)
+PROCESSED_URLS_MAX = 10_000
+# How long a handled listing URL is skipped before it may be visited again
+PROCESSED_URLS_TTL_SECONDS = 7 * 24 * 3600
+
+# How many listing pages are driven at once within the shared browser context
+LISTING_CONCURRENCY = 4
+
+# Fetch listings over plain HTTP first and skip blocked / clearly short-term
+# ones without opening a browser page; set LISTING_HTTP_PREFILTER=0 to disable
+LISTING_HTTP_PREFILTER = os.getenv("LISTING_HTTP_PREFILTER", "1") != "0"
+# Short on purpose: a slow pre-check only delays the browser, so past this
+# the listing goes straight to Playwright
+LISTING_HTTP_TIMEOUT_SECONDS = 1.5
+
+# Context-wide Playwright defaults (ms); individual waits override where needed
+LISTING_ACTION_TIMEOUT_MS = 5000
+LISTING_NAV_TIMEOUT_MS = 30000
+
+# Requests the listing pages never need: media and fonts by resource type,
+# analytics/ads by URL. Stylesheets still load, since visibility checks and
+# innerText depend on the layout.
+LISTING_BLOCKED_RESOURCE_TYPES = frozenset({"image", "font", "media"})
+LISTING_BLOCKED_URL_PARTS = ("googletagmanager", "google-analytics", "doubleclick", "hotjar", "facebook.net")
+
+# Env values that override variables.txt; the environment is fixed for the
+# process lifetime, so read it once instead of on every get_config() call
+_ENV_OVERRIDES = {
+    key: os.environ[key]
+    for key in ("EMAIL_FROM", "PREWRITTEN_MESSAGE", "BLOCK_KEYWORDS")
+    if os.environ.get(key)
+}
+COOKIES_JSON = os.getenv("COOKIES_JSON")
+
+# True once the Contact click has settled: message dialog open or inbox reached
+_CONTACT_SETTLED_JS = (
+    "() => location.href.includes('indbakke') || location.href.includes('inbox') || "
+    "!!document.querySelector(\"div[role='dialog'] textarea, textarea#__TextField1\")"
+)
+# Every text the listing checks read, collected in one evaluate call
+_LISTING_SNAPSHOT_JS = """() => {
+    const text = (sel) => {
+        const el = document.querySelector(sel);
+        return el ? el.innerText : null;
+    };
+    return {
+        title: text("span.css-v34a4n"),
+        details: Array.from(document.querySelectorAll("div.css-o9y6d5"), d => d.innerText),
+        terms: [text("div.css-1o5zkyw") || "", text("div.css-1f7mpex") || ""],
+        logged_in: !/log ind/i.test(document.body ? document.body.innerText : ""),
+    };
+}"""
+# Rendered once the listing text the snapshot reads is on the page
+_LISTING_CONTENT_SELECTOR = "div.css-o9y6d5, span.css-v34a4n"
+# Button names / text patterns, compiled once rather than per listing.
+# Names and fallback texts must match exactly, so a "Kontakt os" header/footer
+# button can't win; the inbox labels (already contacted) are only used when no
+# Contact label is on the page, so a nav-bar inbox button can't either.
+_CONTACT_NAME_RE = re.compile(r"^(Contact|Kontakt|Skriv til udlejer)$", re.I)
+_INBOX_NAME_RE = re.compile(r"^(Go to inbox|Gå til beskeder)$", re.I)
+_SEND_NAME_RE = re.compile(r"^Send$", re.I)
+# Exact-text fallbacks for the buttons, joined into one selector each
+_CONTACT_SELECTOR = ", ".join((
+    "button:text-is('Contact')",
+    "button:text-is('Kontakt')",
+    "button:text-is('Skriv til udlejer')",
+))
+_INBOX_SELECTOR = ", ".join((
+    "button:text-is('Go to inbox')",
+    "button:text-is('Gå til beskeder')",
+))
+# The message field (known id, dialog textarea, any textarea), visible ones only
+_TEXTAREA_SELECTOR = "textarea#\\__TextField1, div[role='dialog'] textarea, textarea >> visible=true"
+_SEND_SELECTOR = "div[role='dialog'] button:has-text('Send'), button:has-text('Send')"
+# Title fallback ("... m²") and the ZIP an address starts at
+_AREA_RE = re.compile(r"\bm²\b")
+_ZIP_RE = re.compile(r"\b\d{4}\b")
+
 # =========================
 # VARIABLES.TXT LOADER
 # =========================
 
-def load_varfile(path: str) -> Dict[str, str]:
-    """
-    Very simple KEY=VALUE parser. Lines starting with # are ignored.
-    Supports \n inside values to represent newlines.
-    """
+@functools.lru_cache(maxsize=8)
+def _parse_varfile(path: str, mtime_ns: int) -> Mapping[str, str]:
     data: Dict[str, str] = {}
-    if not path or not os.path.exists(path):
-        return data
     with open(path, "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -62,7 +174,21 @@ def load_varfile(path: str) -> Dict[str, str]:
             v = v.strip()
             v = v.replace("\\n", "\n")
             data[k] = v
-    return data
+    return MappingProxyType(data)
+
+def load_varfile(path: str) -> Mapping[str, str]:
+    """
+    Very simple KEY=VALUE parser. Lines starting with # are ignored.
+    Supports \n inside values to represent newlines.
+    The parsed result is cached until the file's mtime changes.
+    """
+    if not path:
+        return {}
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+    return _parse_varfile(path, mtime_ns)
 
 def get_config() -> Dict[str, str]:
     """
@@ -71,15 +197,36 @@ def get_config() -> Dict[str, str]:
     file_vars = load_varfile(VARIABLES_FILE)
     cfg = dict(file_vars)
     # env vars override file
-    for key in ["EMAIL_FROM", "PREWRITTEN_MESSAGE", "BLOCK_KEYWORDS"]:
-        if os.getenv(key):
-            cfg[key] = os.getenv(key)
+    cfg.update(_ENV_OVERRIDES)
     return cfg
 
 # =========================
 # GMAIL HELPERS
 # =========================
 
+def _token_needs_refresh(creds: Credentials) -> bool:
+    """
+    True if there is no access token yet or it expires within
+    GMAIL_TOKEN_REFRESH_MARGIN. creds.expiry is naive UTC.
+    """
+    if not creds.token:
+        return True
+    if creds.expiry is None:
+        return False
+    now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry - GMAIL_TOKEN_REFRESH_MARGIN <= now_utc
+
+def save_gmail_token(creds: Credentials) -> None:
+    """
+    Persists the (refreshed) token to token.json so restarts start from a
+    live access token. No-op where the filesystem is read-only.
+    """
+    try:
+        with open(TOKEN_JSON_PATH, "w", encoding="utf-8") as f:
+            f.write(creds.to_json())
+    except Exception:
+        pass
+
 def load_gmail_credentials() -> Credentials:
     """
     Loads Gmail OAuth credentials with sensible precedence:
@@ -93,7 +240,7 @@ def load_gmail_credentials() -> Credentials:
     token_env = os.getenv("GMAIL_TOKEN")
     if token_env:
         try:
-            info = json.loads(token_env)
+            info = orjson.loads(token_env)
             creds = Credentials.from_authorized_user_info(info, GMAIL_SCOPES)
         except Exception as e:
             msg = f"[Gmail] Invalid GMAIL_TOKEN JSON: {e}"
@@ -103,22 +250,19 @@ def load_gmail_credentials() -> Credentials:
     # 2) Local token.json
     if creds is None and os.path.exists(TOKEN_JSON_PATH):
         try:
-            creds = Credentials.from_authorized_user_file(TOKEN_JSON_PATH, GMAIL_SCOPES)
+            with open(TOKEN_JSON_PATH, "rb") as f:
+                info = orjson.loads(f.read())
+            creds = Credentials.from_authorized_user_info(info, GMAIL_SCOPES)
         except Exception as e:
             msg = f"[Gmail] Invalid token.json: {e}"
             print(msg)
             notify_discord("failed", "", extra=msg)
 
-    # Try to refresh if expired and we have a refresh token
-    if creds and creds.expired and creds.refresh_token:
+    # Try to refresh if expired (or about to) and we have a refresh token
+    if creds and creds.refresh_token and _token_needs_refresh(creds):
         try:
             creds.refresh(Request())
-            # if we loaded from file, persist the refreshed token
-            try:
-                with open(TOKEN_JSON_PATH, "w", encoding="utf-8") as f:
-                    f.write(creds.to_json())
-            except Exception:
-                pass
+            save_gmail_token(creds)
             return creds
         except Exception as e:
             msg = f"[Gmail] Refresh failed — re-auth required: {e}"
@@ -131,9 +275,11 @@ def load_gmail_credentials() -> Credentials:
         return creds
 
     # 3) First-time auth (local): use env GMAIL_CREDENTIALS JSON or credentials.json file
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
     client_json = os.getenv("GMAIL_CREDENTIALS")
     if client_json:
-        config = json.loads(client_json)
+        config = orjson.loads(client_json)
         flow = InstalledAppFlow.from_client_config(config, GMAIL_SCOPES)
     else:
         flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_JSON_PATH, GMAIL_SCOPES)
@@ -142,52 +288,195 @@ def load_gmail_credentials() -> Credentials:
     creds = flow.run_local_server(port=0, access_type="offline", prompt="consent")
 
     # Save locally for next runs (no-op on Railway)
-    try:
-        with open(TOKEN_JSON_PATH, "w", encoding="utf-8") as f:
-            f.write(creds.to_json())
-    except Exception:
-        pass
+    save_gmail_token(creds)
 
     return creds
 
+@functools.lru_cache(maxsize=1)
 def get_gmail_service(creds: Credentials):
-    return build("gmail", "v1", credentials=creds)
+    """
+    Builds the Gmail client from the discovery document bundled with
+    google-api-python-client (no network fetch) and reuses it per creds.
+    """
+    return build("gmail", "v1", credentials=creds, static_discovery=True, cache_discovery=False)
 
 def list_unread_boligportal_messages(service, sender_email: str) -> List[dict]:
     """
     Finds unread messages from BoligPortal. Adjust if needed.
     """
     query = f"from:{sender_email} is:unread newer_than:7d"
-    resp = service.users().messages().list(userId="me", q=query, maxResults=10).execute()
+    # Only ids are used; skip threadId / resultSizeEstimate in the response
+    resp = service.users().messages().list(
+        userId="me", q=query, maxResults=GMAIL_LIST_PAGE_SIZE, fields="messages/id"
+    ).execute()
     return resp.get("messages", []) or []
 
-def fetch_message_html(service, msg_id: str) -> Optional[str]:
+def get_history_id(service) -> str:
+    """
+    Returns the mailbox's current historyId (starting point for has_new_unread_messages).
+    """
+    return service.users().getProfile(userId="me", fields="historyId").execute()["historyId"]
+
+def has_new_unread_messages(service, start_history_id: str) -> Tuple[bool, str]:
+    """
+    Asks the history API whether unread messages were added since
+    start_history_id; far cheaper than re-running the 7-day search.
+    Returns (changed, latest historyId). An expired start id counts as changed.
+    """
+    try:
+        resp = service.users().history().list(
+            userId="me",
+            startHistoryId=start_history_id,
+            historyTypes=["messageAdded"],
+            labelId="UNREAD",
+            maxResults=1,
+            fields="history/id,historyId",
+        ).execute()
+    except HttpError as he:
+        # 404: start id is too old (history is kept ~a week); resync
+        if getattr(he, "status_code", None) == 404:
+            return True, get_history_id(service)
+        raise
+    return bool(resp.get("history")), resp.get("historyId", start_history_id)
+
+def _decode_body(data: str) -> str:
     """
-    Downloads the message and returns the HTML body (if available).
+    Decodes a Gmail base64url body. urlsafe_b64decode accepts the ASCII str
+    directly; Gmail may omit the padding, so it is restored first.
     """
-    msg = service.users().messages().get(userId="me", id=msg_id, format="full").execute()
-    payload = msg.get("payload", {})
-    parts = payload.get("parts", [])
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)).decode("utf-8", errors="ignore")
 
-    # Look for the HTML part first
-    if parts:
-        for p in parts:
-            if p.get("mimeType") == "text/html":
-                data = p.get("body", {}).get("data")
-                if data:
-                    return base64.urlsafe_b64decode(data.encode("utf-8")).decode("utf-8", errors="ignore")
+def _walk_parts(parts: List[dict]):
+    """
+    Yields MIME parts depth-first, descending into nested multiparts lazily.
+    """
+    for p in parts:
+        yield p
+        yield from _walk_parts(p.get("parts") or [])
 
-    # Fallback (sometimes only body)
-    body_data = payload.get("body", {}).get("data")
-    if body_data:
-        return base64.urlsafe_b64decode(body_data.encode("utf-8")).decode("utf-8", errors="ignore")
+def _message_html(msg: dict) -> Optional[str]:
+    """
+    Returns the HTML body (if available) of a messages.get response,
+    stopping at the first text/html part at any nesting depth.
+    Missing fields count as "no HTML": this runs inside the batch callback,
+    where one malformed response must not abort the rest of the batch.
+    """
+    html_part = next(
+        (p for p in _walk_parts([msg.get("payload") or {}])
+         if p.get("mimeType") == "text/html" and p.get("body", {}).get("data")),
+        None,
+    )
+    if html_part is None:
+        return None
+    return _decode_body(html_part["body"]["data"])
 
-    return None
+def fetch_messages_html(service, msg_ids: List[str]) -> Dict[str, Optional[str]]:
+    """
+    Downloads several messages in batch HTTP requests (GMAIL_BATCH_SIZE
+    per request) instead of one round-trip per message.
+    Returns {msg_id: html or None}.
+    """
+    results: Dict[str, Optional[str]] = {}
+
+    def _collect(request_id, response, exception):
+        if exception is not None:
+            print(f"[Bot] Failed to fetch email {request_id}: {exception}")
+            results[request_id] = None
+        else:
+            results[request_id] = _message_html(response)
+
+    for start in range(0, len(msg_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=_collect)
+        for msg_id in msg_ids[start:start + GMAIL_BATCH_SIZE]:
+            batch.add(
+                service.users().messages().get(
+                    userId="me", id=msg_id, format="full", fields=GMAIL_MESSAGE_FIELDS
+                ),
+                request_id=msg_id,
+            )
+        batch.execute()
+    return results
+
+def mark_messages_read(service, msg_ids: List[str]) -> None:
+    """
+    Removes the UNREAD label from all given messages with one batchModify call.
+    """
+    if not msg_ids:
+        return
+    try:
+        service.users().messages().batchModify(
+            userId="me",
+            body={"ids": msg_ids, "removeLabelIds": ["UNREAD"]}
+        ).execute()
+    except HttpError as he:
+        print(f"[Bot] Failed to mark emails {', '.join(msg_ids)} as read: {he}")
+
+def start_gmail_watch(service) -> float:
+    """
+    Asks Gmail to publish INBOX changes to GMAIL_PUBSUB_TOPIC.
+    Returns the watch expiration as a unix timestamp (seconds), or 0.0 if the
+    call failed (the caller polls meanwhile and tries again next cycle).
+    """
+    try:
+        resp = service.users().watch(
+            userId="me",
+            body={"labelIds": ["INBOX"], "topicName": GMAIL_PUBSUB_TOPIC}
+        ).execute()
+    except HttpError as he:
+        print(f"[Gmail] Could not enable push notifications: {he}")
+        return 0.0
+    print("[Gmail] Push notifications enabled.")
+    return int(resp.get("expiration", 0)) / 1000
+
+def create_pubsub_subscriber():
+    """
+    Returns a Pub/Sub SubscriberClient (application default credentials),
+    or None if push notifications are not configured (or google-cloud-pubsub
+    is not installed).
+    """
+    if not (GMAIL_PUBSUB_TOPIC and GMAIL_PUBSUB_SUBSCRIPTION):
+        return None
+    try:
+        from google.cloud import pubsub_v1
+    except ImportError:
+        print("[Gmail] google-cloud-pubsub is not installed; polling instead of push.")
+        return None
+    return pubsub_v1.SubscriberClient()
+
+def wait_for_gmail_push(subscriber, timeout: float) -> Optional[bool]:
+    """
+    Blocks until Gmail publishes a mailbox change or timeout passes.
+    Acknowledges what was received; returns True if anything arrived, or
+    None if Pub/Sub failed (the caller then sleeps POLL_SECONDS instead).
+    """
+    from google.api_core.exceptions import DeadlineExceeded, GoogleAPICallError
+    try:
+        resp = subscriber.pull(
+            request={"subscription": GMAIL_PUBSUB_SUBSCRIPTION, "max_messages": 100},
+            retry=None,
+            timeout=timeout,
+        )
+        ack_ids = [m.ack_id for m in resp.received_messages]
+        if ack_ids:
+            subscriber.acknowledge(request={"subscription": GMAIL_PUBSUB_SUBSCRIPTION, "ack_ids": ack_ids})
+    except DeadlineExceeded:
+        return False
+    except GoogleAPICallError as e:
+        # Transient (ServiceUnavailable, PermissionDenied, ...): poll this cycle
+        print(f"[Gmail] Pub/Sub pull failed: {e}")
+        return None
+    return bool(ack_ids)
 
 # =========================
 # EMAIL HTML → LINKS
 # =========================
 
+# First boligportal.dk URL inside a percent-decoded tracking tail
+_BOLIG_URL_RE = re.compile(r"https://www\.boligportal\.dk[^\s\"']+")
+_GOOGLE_REDIRECT_PREFIX = "https://www.google.com/url?"
+
+# Pure in href, and digests repeat the same wrapped link per button/image
+@functools.lru_cache(maxsize=4096)
 def _decode_awstrack_or_google_redirect(href: str) -> str:
     """
     BoligPortal emails often wrap links with tracking, e.g.:
@@ -195,12 +484,20 @@ def _decode_awstrack_or_google_redirect(href: str) -> str:
     or gmail's https://www.google.com/url?q=<real_url>
     This tries to extract and URL-decode the real boligportal.dk URL.
     """
-    # Google redirect
-    if href.startswith("https://www.google.com/url?"):
-        parsed = urllib.parse.urlparse(href)
-        q = urllib.parse.parse_qs(parsed.query).get("q", [""])[0]
-        if q:
-            href = q
+    is_google = href.startswith(_GOOGLE_REDIRECT_PREFIX)
+    # No tracking wrapper: nothing to unwrap
+    if not is_google and "/L0/" not in href:
+        return href
+
+    # Google redirect: pull the q= parameter without building a parse_qs dict
+    if is_google:
+        query = href[len(_GOOGLE_REDIRECT_PREFIX):].split("#", 1)[0]
+        for param in query.split("&"):
+            if param.startswith("q="):
+                q = urllib.parse.unquote_plus(param[2:])
+                if q:
+                    href = q
+                break
 
     # AWS track style ".../L0/<percent-encoded-url>"
     if "/L0/" in href:
@@ -211,7 +508,7 @@ def _decode_awstrack_or_google_redirect(href: str) -> str:
             decoded = urllib.parse.unquote(after)
             # The decoded may still contain trailing path/ids; strip common /<digits>/ patterns
             # But safest: find first "https://www.boligportal.dk"
-            m = re.search(r"https://www\.boligportal\.dk[^\s\"']+", decoded)
+            m = _BOLIG_URL_RE.search(decoded)
             if m:
                 href = m.group(0)
         except Exception:
@@ -219,7 +516,149 @@ def _decode_awstrack_or_google_redirect(href: str) -> str:
 
     return href
 
-def extract_listing_links_from_email_html(html: str) -> List[str]:
+# Raw href values; listing pages end in "...-id-<digits>", which tells them
+# apart from the search / "See all results" links in the same email
+_HREF_RE = re.compile(r"""href=["']([^"']+)["']""", re.I)
+_LISTING_PATH_RE = re.compile(r"-id-\d+/?$")
+RENTED_OUT_MARKER = "The property has been marked as rented out"
+
+# Set EMAIL_LINKS_DOM_ONLY=1 to skip the regex scan and always walk the DOM
+EMAIL_LINKS_DOM_ONLY = os.getenv("EMAIL_LINKS_DOM_ONLY") == "1"
+
+def _normalize_listing_href(href: str) -> Optional[str]:
+    """
+    Unwraps tracking redirects and strips query/fragment.
+    Returns None for non-boligportal links.
+    """
+    href = _decode_awstrack_or_google_redirect(href.strip())
+    if "boligportal.dk" not in href:
+        return None
+    # Cut at the query/fragment; same result as rebuilding from urlparse
+    # without allocating a ParseResult per link
+    return href.split("#", 1)[0].split("?", 1)[0]
+
+# Opening and closing table/tbody/tr tags: enough to find the items row
+# without building a DOM
+_TABLE_TAG_RE = re.compile(r"<(/?)(table|tbody|tr)\b[^>]*>", re.I)
+
+def _items_row_span(html: str) -> Optional[Tuple[int, int]]:
+    """
+    Locates the row _items_row_hrefs reads (second top-level <tr> of the
+    first tbody with at least 3 rows, else of the first tbody) from the
+    table tags alone. Returns its (start, end) offsets, or None if there is
+    no such row or the tags are not properly nested.
+    """
+    # Open elements: ["table"], ["tbody", order, rows, row 2 span],
+    # ["tr", start, tbody entry if this is its row 2]
+    stack: List[list] = []
+    open_tbodies = seen_tbodies = 0
+    first = best = None
+    for m in _TABLE_TAG_RE.finditer(html):
+        closing, tag = m.group(1), m.group(2).lower()
+        if not closing:
+            if tag == "tbody":
+                entry = ["tbody", seen_tbodies, 0, None]
+                seen_tbodies += 1
+                open_tbodies += 1
+                if first is None:
+                    first = entry
+            elif tag == "tr":
+                # An unclosed row: leave it to the HTML parser
+                if not stack or stack[-1][0] == "tr":
+                    return None
+                parent = stack[-1]
+                second_of = None
+                if parent[0] == "tbody":
+                    parent[2] += 1
+                    if parent[2] == 2:
+                        second_of = parent
+                entry = ["tr", m.start(), second_of]
+            else:
+                entry = ["table"]
+            stack.append(entry)
+            continue
+
+        if not stack or stack[-1][0] != tag:
+            return None
+        entry = stack.pop()
+        if tag == "tr" and entry[2] is not None:
+            entry[2][3] = (entry[1], m.end())
+        elif tag == "tbody":
+            open_tbodies -= 1
+            # Same rule and early stop as _items_row_hrefs
+            if entry[2] >= 3 and (best is None or entry[1] < best[1]):
+                best = entry
+            if best is not None and not open_tbodies:
+                break
+
+    target = best if best is not None else first
+    return target[3] if target is not None else None
+
+def _extract_listing_links_by_regex(html: str) -> List[str]:
+    """
+    Scans raw href attributes of the items row without building a DOM and
+    keeps only listing URLs, de-duplicated in order. Returns [] if the email
+    does not look as expected, in which case the caller falls back to the
+    DOM walk.
+    """
+    span = _items_row_span(html)
+    if span is None:
+        return []
+    links: Dict[str, None] = {}
+    for m in _HREF_RE.finditer(html, *span):
+        url = _normalize_listing_href(unescape(m.group(1)))
+        if url and _LISTING_PATH_RE.search(url):
+            links[url] = None
+    return list(links)
+
+# The fallback parser is fed this many characters at a time so it can stop early
+_EMAIL_FEED_CHUNK = 16 * 1024
+
+def _items_row_hrefs(html: str) -> List[str]:
+    """
+    Streams the email through lxml's HTMLPullParser and returns the raw
+    hrefs inside the second top-level <tr> of the target <tbody>: the first
+    tbody with at least 3 rows, else the first tbody. Only tbody events reach
+    Python; rows and anchors are read with XPath once a tbody has closed, and
+    parsing stops once the target is known and no enclosing tbody is open.
+    """
+    from lxml import etree
+
+    parser = etree.HTMLPullParser(events=("start", "end"), tag="tbody")
+
+    def _events():
+        for i in range(0, len(html), _EMAIL_FEED_CHUNK):
+            parser.feed(html[i:i + _EMAIL_FEED_CHUNK])
+            yield from parser.read_events()
+        try:
+            parser.close()
+        except etree.XMLSyntaxError:
+            return
+        yield from parser.read_events()
+
+    # (document order, element) of the open tbodies
+    open_tbodies: List[Tuple[int, object]] = []
+    seen_tbodies = 0
+    first = best = None
+    for event, el in _events():
+        if event == "start":
+            open_tbodies.append((seen_tbodies, el))
+            seen_tbodies += 1
+            if first is None:
+                first = el
+            continue
+        order, _ = open_tbodies.pop()
+        # Earliest-starting qualifying tbody wins; an enclosing tbody that
+        # is still open started earlier, so only stop once none is open
+        if el.xpath("count(tr)") >= 3 and (best is None or order < best[0]):
+            best = (order, el)
+        if best is not None and not open_tbodies:
+            break
+
+    target = best[1] if best is not None else first
+    return target.xpath("tr[2]//a/@href") if target is not None else []
+
+def _extract_listing_links_from_dom(html: str) -> List[str]:
     """
     Using your structure:
       <table>
@@ -227,56 +666,36 @@ def extract_listing_links_from_email_html(html: str) -> List[str]:
           <tr> 'Your search' (nested) </tr>
           <tr> (items we want) </tr>   <-- take anchors here
           <tr> 'See all results' (nested) </tr>
-    We target tbody > tr:nth-of-type(2) and collect <a> inside (dedupe, normalize).
+    We target tbody > tr:nth-of-type(2) and collect <a> inside (normalized).
     """
-    soup = BeautifulSoup(html, "html.parser")
-
-    # Early exit if property is marked as rented out
-    rented_out_div = soup.find("div", string=lambda s: s and "The property has been marked as rented out" in s)
-    if rented_out_div:
+    if not html.strip():
         return []
 
-    # Pick the first (main) tbody; adjust if multiple
-    tbodies = soup.find_all("tbody")
-    if not tbodies:
-        return []
+    # dict keys keep first-seen order and drop repeats in the same pass
+    links: Dict[str, None] = {}
+    for href in _items_row_hrefs(html):
+        url = _normalize_listing_href(href)
+        if url:
+            links[url] = None
+    return list(links)
 
-    # Heuristic: choose the tbody with at least 3 trs (your structure)
-    target_tbody = None
-    for tb in tbodies:
-        trs = tb.find_all("tr", recursive=False)
-        if len(trs) >= 3:
-            target_tbody = tb
-            break
-    if not target_tbody:
-        # fallback: first tbody
-        target_tbody = tbodies[0]
-
-    trs_top = target_tbody.find_all("tr", recursive=False)
-    if len(trs_top) < 2:
+def extract_listing_links_from_email_html(html: str) -> List[str]:
+    """
+    Returns the de-duplicated listing URLs of a BoligPortal email.
+    A regex scan over the raw hrefs handles the usual layout; the DOM walk
+    is only used when that finds nothing (or EMAIL_LINKS_DOM_ONLY is set).
+    """
+    # Early exit if property is marked as rented out
+    if RENTED_OUT_MARKER in html:
         return []
 
-    items_tr = trs_top[1]  # the second <tr> with items
-    anchors = items_tr.find_all("a", href=True)
     links: List[str] = []
+    if not EMAIL_LINKS_DOM_ONLY:
+        links = _extract_listing_links_by_regex(html)
+    if not links:
+        links = _extract_listing_links_from_dom(html)
 
-    for a in anchors:
-        href = a["href"].strip()
-        href = _decode_awstrack_or_google_redirect(href)
-        if "boligportal.dk" in href:
-            parsed = urlparse(href)
-            base_url = f'{parsed.scheme}://{parsed.netloc}{parsed.path}'
-            links.append(base_url)
-
-    # De-duplicate preserving order
-    seen = set()
-    cleaned = []
-    for u in links:
-        if u not in seen:
-            seen.add(u)
-            cleaned.append(u)
-
-    return cleaned
+    return links
 
 # =========================
 # PLAYWRIGHT HELPERS
@@ -284,12 +703,14 @@ def extract_listing_links_from_email_html(html: str) -> List[str]:
 
 def ensure_gmail_token(creds) -> bool:
     """
-    Try to refresh the Gmail access token. 
+    Refresh the Gmail access token only when it is within
+    GMAIL_TOKEN_REFRESH_MARGIN of expiring; a live token costs no network call.
     Returns True if usable, False if refresh failed or creds missing.
     """
     try:
-        if creds and creds.expired and creds.refresh_token:
+        if creds and creds.refresh_token and _token_needs_refresh(creds):
             creds.refresh(Request())
+            save_gmail_token(creds)
         return True
     except Exception as e:
         msg = f"Gmail token refresh failed: {e}"
@@ -297,76 +718,229 @@ def ensure_gmail_token(creds) -> bool:
         notify_discord("expired_session", "", extra=msg)
         return False
 
-def load_cookies_into_context(context):
-    raw = os.getenv("COOKIES_JSON")
+async def notify_discord_async(*args, **kwargs) -> None:
+    """
+    notify_discord from inside a listing coroutine: the webhook POST runs in
+    a worker thread so the other pages in flight keep going meanwhile.
+    """
+    await asyncio.to_thread(notify_discord, *args, **kwargs)
+
+@functools.lru_cache(maxsize=1)
+def _load_cookies() -> List[dict]:
+    """
+    Reads COOKIES_JSON (env) or cookies.json once per process and
+    normalises sameSite values; later calls reuse the parsed list.
+    """
+    raw = COOKIES_JSON
     if not raw:
-        with open(COOKIES_JSON_PATH, "r", encoding="utf-8") as f:
+        with open(COOKIES_JSON_PATH, "rb") as f:
             raw = f.read()
-    cookies = json.loads(raw)
+    cookies = orjson.loads(raw)
     for cookie in cookies:
         if "sameSite" in cookie:
             # Normalise unrecognised values
             if cookie["sameSite"] not in ("Strict", "Lax", "None"):
                 # Choose a sensible default; Lax is usually fine
                 cookie["sameSite"] = "Lax"
-    context.add_cookies(cookies)
+    return cookies
 
-def cookies_are_valid(page) -> bool:
-    pageContent = page.content().lower()
-    return ("log ind" not in pageContent)
+async def load_cookies_into_context(context):
+    await context.add_cookies(_load_cookies())
 
-def page_contains_block_keywords(page: Page, keywords_csv: str) -> Tuple[bool, Optional[str]]:
+async def save_storage_state(context) -> None:
+    try:
+        await context.storage_state(path=STORAGE_STATE_PATH)
+    except Exception as e:
+        print(f"[Playwright] Could not save browser state: {e}")
+
+def discard_storage_state() -> None:
+    # The saved session no longer logs in: the cookies are used again
+    try:
+        os.remove(STORAGE_STATE_PATH)
+    except OSError:
+        pass
+
+def cookies_are_valid(snapshot: dict) -> bool:
+    # The "Log ind" link only shows when logged out; the snapshot script tests
+    # the rendered text in the browser, so no extra round-trip is needed here
+    return snapshot.get("logged_in", True)
+
+@functools.lru_cache(maxsize=4)
+def compile_block_keywords(keywords_csv: str) -> Optional[Pattern[str]]:
     """
-    Returns True if any keyword from BLOCK_KEYWORDS appears in the
-    text of a <div class="css-o9y6d5"> element. If no such divs are found,
-    or none contain the keywords, returns False.
+    Builds one case-insensitive alternation from the BLOCK_KEYWORDS CSV,
+    so a page is scanned once instead of once per keyword.
+    Uses google-re2 (linear-time DFA) when installed, else the stdlib re.
+    Returns None if no keywords are configured. Cached per CSV value.
     """
-    if not keywords_csv.strip():
-        return False, None
-
-    # Normalise the keywords once
-    keywords = [kw.strip().lower() for kw in keywords_csv.split(",") if kw.strip()]
+    keywords = {kw.strip().lower() for kw in (keywords_csv or "").split(",") if kw.strip()}
     if not keywords:
-        return False, None
+        return None
+    # Longest first so overlapping keywords report the most specific match
+    ordered = sorted(keywords, key=lambda kw: (-len(kw), kw))
+    try:
+        import re2
+    except ImportError:
+        return re.compile("|".join(re.escape(kw) for kw in ordered), re.IGNORECASE)
+    return re2.compile("(?i)" + "|".join(re2.escape(kw) for kw in ordered))
 
+async def read_listing_snapshot(page: Page) -> dict:
+    """
+    Reads everything the listing checks need in one page.evaluate round-trip:
+      - title: text of <span class="css-v34a4n"> (or None)
+      - details: inner texts of all <div class="css-o9y6d5"> elements
+      - terms: texts of the first div.css-1o5zkyw and div.css-1f7mpex ("" if missing)
+      - logged_in: False if the rendered page text contains "Log ind"
+    The details feed both the block-keyword check and the address lookup;
+    the terms feed the short-term check.
+    """
     try:
-        # Get all inner texts of the target divs at once
-        texts = page.locator("div.css-o9y6d5").all_inner_texts()
+        snapshot = await page.evaluate(_LISTING_SNAPSHOT_JS)
     except Exception:
-        # If selector fails or no elements, treat as empty list
-        texts = []
+        # If the page is gone or the script fails, treat as empty
+        snapshot = None
+    return snapshot or {"title": None, "details": [], "terms": [], "logged_in": True}
 
-    # Combine and lower‑case the text from all matching divs
-    combined_text = " ".join(t.lower() for t in texts)
+def page_contains_block_keywords(detail_texts: List[str], block_re: Optional[Pattern[str]]) -> Tuple[bool, Optional[str]]:
+    """
+    Returns True if any keyword from BLOCK_KEYWORDS (compiled with
+    compile_block_keywords) appears in the detail div texts from
+    read_listing_snapshot. If there are none, or none contain the keywords, returns False.
+    """
+    if block_re is None:
+        return False, None
 
-    # Check each keyword against the combined text
-    for kw in keywords:
-        if kw in combined_text:
-            return True, kw
+    # One C-level scan over the combined text; the pattern is case-insensitive
+    m = block_re.search(" ".join(detail_texts))
+    if m:
+        return True, m.group(0).lower()
     return False, None
 
-def page_contains_short_term(page: Page, months_threshold: int = 8) -> Optional[dict]:
+def short_term_from_texts(term_texts: List[str], months_threshold: int = 8) -> Optional[dict]:
     """
-    Combines text from the first <div class="css-1o5zkyw"> and <div class="css-1f7mpex">,
-    passes to is_short_term_heuristic, and returns the result dict.
-    Returns None if both divs are missing or empty.
+    Combines the rental-period texts (css-1o5zkyw, css-1f7mpex), passes them
+    to is_short_term_heuristic, and returns the result dict.
+    Returns None if all texts are missing or empty.
     """
+    combined_text = " ".join(t.strip() for t in term_texts if t and t.strip())
+    if not combined_text:
+        return None
+    return is_short_term_heuristic(combined_text, months_threshold=months_threshold)
+
+def _class_xpath(tag: str, css_class: str) -> str:
+    return f"//{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {css_class} ')]"
+
+_DETAIL_DIVS_XPATH = _class_xpath("div", "css-o9y6d5")
+_TERM_DIVS_XPATHS = (_class_xpath("div", "css-1o5zkyw"), _class_xpath("div", "css-1f7mpex"))
+
+@functools.lru_cache(maxsize=1)
+def _listing_http_session() -> requests.Session:
+    """
+    requests session carrying the BoligPortal cookies, shared by all
+    fetch_listing_snapshot calls.
+    """
+    session = requests.Session()
+    session.headers.update({
+        "User-Agent": (
+            "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+            "(KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+        ),
+        "Accept-Language": "da-DK,da;q=0.9,en;q=0.8",
+    })
     try:
-        text1 = ""
-        text2 = ""
-        div1 = page.locator("div.css-1o5zkyw").first
-        if div1.count() > 0:
-            text1 = div1.inner_text().strip()
-        div2 = page.locator("div.css-1f7mpex").first
-        if div2.count() > 0:
-            text2 = div2.inner_text().strip()
-        combined_text = " ".join(t for t in [text1, text2] if t)
-        if not combined_text:
-            return None
-        return is_short_term_heuristic(combined_text, months_threshold=months_threshold)
-    except Exception as e:
-        print(f"[Playwright] Error in page_contains_short_term: {e}")
+        for c in _load_cookies():
+            session.cookies.set(c["name"], c["value"], domain=c.get("domain", ""), path=c.get("path", "/"))
+    except (OSError, ValueError, KeyError):
+        # No usable cookies: the listing text is public anyway
+        pass
+    return session
+
+def _node_text(el) -> str:
+    return " ".join(" ".join(el.itertext()).split())
+
+def fetch_listing_snapshot(url: str) -> Optional[dict]:
+    """
+    Fetches the listing's server-rendered HTML without a browser and returns
+      - details: texts of the div.css-o9y6d5 elements
+      - terms: texts of the first div.css-1o5zkyw and div.css-1f7mpex
+    Returns None if the request fails or the detail divs are not in the HTML
+    (e.g. rendered client-side), so the caller falls back to Playwright.
+    Blocking; run it in a worker thread.
+    """
+    from lxml import html as lxml_html
+
+    try:
+        resp = _listing_http_session().get(url, timeout=LISTING_HTTP_TIMEOUT_SECONDS)
+        resp.raise_for_status()
+    except requests.RequestException:
+        return None
+    if not resp.content:
+        return None
+
+    try:
+        # BoligPortal serves UTF-8; without this lxml falls back to latin-1
+        # whenever the document has no <meta charset>
+        root = lxml_html.fromstring(resp.content, parser=lxml_html.HTMLParser(encoding="utf-8"))
+    except (lxml_html.etree.ParserError, ValueError):
+        return None
+    details = [_node_text(el) for el in root.xpath(_DETAIL_DIVS_XPATH)]
+    if not details:
         return None
+    terms = []
+    for xpath in _TERM_DIVS_XPATHS:
+        found = root.xpath(xpath)
+        terms.append(_node_text(found[0]) if found else "")
+    return {"details": details, "terms": terms}
+
+def _skip_decision(details: List[str], terms: List[str], block_re: Optional[Pattern[str]]) -> Tuple[Optional[str], str, bool]:
+    """
+    The block-keyword and short-term checks shared by the HTTP prefilter and
+    the Playwright pass. Returns (kind, detail, short_term_suspected):
+      - kind: "blocked" (detail = keyword) or "short_term" (detail = notification
+        message) if the listing is skipped, else None
+      - short_term_suspected: a lower-confidence short term; still contacted
+    """
+    foundBlockedKeyword, keyword = page_contains_block_keywords(details, block_re)
+    if foundBlockedKeyword:
+        return "blocked", f"{keyword}", False
+
+    termDetector = short_term_from_texts(terms, months_threshold=8)
+    if (termDetector and termDetector.get("is_short_term")):
+        if (termDetector.get("confidence")=="high"):
+            notificationMessage = f"Short term ({termDetector['confidence']}). Reason: {termDetector['reason']}"
+            return "short_term", notificationMessage, False
+        # If low confidence, still allow to contact but notify that there is a suspected short term
+        return None, "", True
+    return None, "", False
+
+async def notify_skipped_listing(url: str, kind: str, detail: str, log_tag: str) -> None:
+    if kind == "blocked":
+        print(f"{log_tag} Block keyword matched '{detail}' — skipping this listing.")
+    else:
+        print(f"{log_tag} Short term {detail} — skipping this listing.")
+    await notify_discord_async(kind, url, detail)
+
+async def prefilter_listing(url: str, block_re: Optional[Pattern[str]]) -> bool:
+    """
+    Runs the block-keyword and short-term checks on the plain-HTTP snapshot.
+    Returns True (and notifies) if the listing can be skipped without opening
+    a browser page; False if it needs the full Playwright pass.
+    """
+    if not LISTING_HTTP_PREFILTER:
+        return False
+    try:
+        # requests' timeout is per connect/read, so also cap the whole fetch
+        snapshot = await asyncio.wait_for(asyncio.to_thread(fetch_listing_snapshot, url), LISTING_HTTP_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        return False
+    if snapshot is None:
+        return False
+
+    kind, detail, _suspected = _skip_decision(snapshot["details"], snapshot["terms"], block_re)
+    if kind is None:
+        return False
+    await notify_skipped_listing(url, kind, detail, "[Bot]")
+    return True
 
 def already_contacted_redirect(url: str) -> bool:
     """
@@ -374,7 +948,19 @@ def already_contacted_redirect(url: str) -> bool:
     """
     return "indbakke" in url.lower() or "inbox" in url.lower()
 
-def click_contact_and_send(page: Page, message_text: str, short_term_suspected = False) -> bool:
+async def contact_button(page: Page):
+    """
+    Waits for the Contact button (exact accessible name, or exact button text
+    as a fallback) and returns it; the "Go to inbox" variant is only returned
+    when no Contact label is on the page.
+    """
+    contact = page.get_by_role("button", name=_CONTACT_NAME_RE).or_(page.locator(_CONTACT_SELECTOR))
+    inbox = page.get_by_role("button", name=_INBOX_NAME_RE).or_(page.locator(_INBOX_SELECTOR))
+    # One wait for whichever renders, then the Contact labels take priority
+    await contact.or_(inbox).first.wait_for()
+    return contact.first if await contact.count() else inbox.first
+
+async def click_contact_and_send(page: Page, message_text: str, short_term_suspected = False, snapshot: Optional[dict] = None) -> bool:
     """
     1) Click 'Contact' button
     2) If redirected to 'indbakke' (already contacted) -> stop
@@ -383,275 +969,458 @@ def click_contact_and_send(page: Page, message_text: str, short_term_suspected =
        - fill message
        - click 'Send'
     """
+    from playwright.async_api import TimeoutError as PWTimeoutError
 
     # Extract listing info (title and address) for notifications
-    advertTitle, advertAddress = extract_listing_info(page)
+    advertTitle, advertAddress = await extract_listing_info(page, snapshot)
 
     # Click the "Contact" button (be flexible with text)
-    # Try multiple strategies
-    contact_clicked = False
-    selectors_try = [
-        lambda: page.locator("button:has-text('Contact')").first.click(timeout=3000),
-        lambda: page.locator("button:has-text('Kontakt')").first.click(timeout=3000),
-        lambda: page.locator("button:has-text('Skriv til udlejer')").first.click(timeout=3000),
-        lambda: page.locator("button:has-text('Go to inbox')").first.click(timeout=3000),
-        lambda: page.locator("button:has-text('Gå til beskeder')").first.click(timeout=3000),
-    ]
-
-    for fn in selectors_try:
-        try:
-            fn()
-            contact_clicked = True
-            break
-        except Exception:
-            continue
-
-    if not contact_clicked:
+    try:
+        await (await contact_button(page)).click()
+    except Exception:
         print("[Playwright] Could not find the Contact button.")
         return False
 
-    # Small wait to allow any navigation or dialog
-    page.wait_for_timeout(800)
+    # Wait until either the message dialog is open or we were sent to the inbox,
+    # instead of sleeping a fixed amount
+    try:
+        await page.wait_for_function(_CONTACT_SETTLED_JS)
+    except Exception:
+        # Timeout, or the context was replaced by a navigation: the URL check below decides
+        pass
 
     # If navigation happened and URL contains 'indbakke' -> already contacted
     current_url = page.url
     if already_contacted_redirect(current_url):
         print("[Playwright] Landed on inbox (indbakke) — already contacted earlier. Skipping.")
-        notify_discord("already", current_url, f"{advertTitle} | {advertAddress}")
+        await notify_discord_async("already", current_url, f"{advertTitle} | {advertAddress}")
         return True  # treat as 'done'
 
     # If a dialog pops up
     # Try to locate the dialog, textarea, and Send button
     try:
-        # Look for a visible textarea
-        textarea = None
-        try:
-            textarea = page.locator("textarea#\\__TextField1").first
-            if not textarea.is_visible():
-                textarea = None
-        except Exception:
-            textarea = None
-
-        if textarea is None:
-            # Any textarea inside an open dialog
-            textarea = page.locator("div[role='dialog'] textarea").first
-            if not textarea or not textarea.is_visible():
-                # fallback: any textarea on page
-                textarea = page.locator("textarea").first
-
-        textarea.click(timeout=5000)
-        textarea.fill(message_text, timeout=8000)
+        # One wait for the first visible message field instead of probing each
+        textarea = page.locator(_TEXTAREA_SELECTOR).first
+        await textarea.wait_for(state="visible")
+        await textarea.fill(message_text, timeout=8000)
 
         # Click Send (text 'Send')
-        sent = False
-        try_send = [
-            lambda: page.get_by_role("button", name=re.compile(r"^Send$", re.I)).click(timeout=5000),
-            lambda: page.locator("div[role='dialog'] button:has-text('Send')").first.click(timeout=5000),
-            lambda: page.locator("button:has-text('Send')").first.click(timeout=5000),
-        ]
-        for fn in try_send:
-            try:
-                fn()
-                sent = True
-                notify_discord("sent", page.url,  f"{advertTitle} | {advertAddress} | {'⚠️Short Term Suspected' if short_term_suspected else ''}")
-                break
-            except Exception:
-                continue
-
-        if not sent:
+        send = page.get_by_role("button", name=_SEND_NAME_RE).or_(
+            page.locator(_SEND_SELECTOR)
+        )
+        try:
+            await send.first.click()
+        except Exception:
             print("[Playwright] Could not find the Send button.")
-            notify_discord("failed", page.url, "Could not find the Send button")
+            await notify_discord_async("failed", page.url, "Could not find the Send button")
             return False
+        async def _dialog_closed() -> None:
+            # Let the dialog close (message submitted) before the page is torn down
+            try:
+                await page.locator("div[role='dialog']").first.wait_for(state="detached", timeout=3000)
+            except PWTimeoutError:
+                pass
 
-        # # tiny wait for any toast/confirmation
-        page.wait_for_timeout(1200)
+        # The Discord post and the dialog close overlap instead of running back to back
+        await asyncio.gather(
+            notify_discord_async("sent", page.url,  f"{advertTitle} | {advertAddress} | {'⚠️Short Term Suspected' if short_term_suspected else ''}"),
+            _dialog_closed(),
+        )
         return True
 
     except Exception as e:
         print(f"[Playwright] Dialog handling failed: {e}")
-        notify_discord("failed", page.url, f"Dialog handling failed: {e}")
+        await notify_discord_async("failed", page.url, f"Dialog handling failed: {e}")
         return False
 
 
-def extract_listing_info(page: Page):
+def address_from_details(details: List[str]) -> Optional[str]:
+    """
+    Returns the first detail text that contains a 4-digit ZIP, sliced from
+    the ZIP to the end of that text, or None. The texts are joined with NULs
+    so one regex search covers them all; the NUL also marks where the
+    matching text ends.
+    """
+    joined = "\0".join(details)
+    m = _ZIP_RE.search(joined)
+    if not m:
+        return None
+    end = joined.find("\0", m.start())
+    return joined[m.start():end if end >= 0 else None].strip()
+
+async def extract_listing_info(page: Page, snapshot: Optional[dict] = None):
     """
     Returns (titleText, addressText)
       - titleText: listing title (e.g., "1 room apartment of 38 m²")
       - addressText: text of the matching address div sliced from the first 4-digit ZIP; or None
+    snapshot is the read_listing_snapshot result (read here if not given);
+    the page is only queried again if it had no title.
     """
+    from playwright.async_api import TimeoutError as PWTimeoutError
+
+    if snapshot is None:
+        snapshot = await read_listing_snapshot(page)
+
     # 1) Title: prefer the exact class you provided
-    titleText = None
-    loc = page.locator("span.css-v34a4n").first
-    try:
-        # Wait for it to be visible and read it
-        loc.wait_for(state="visible", timeout=5000)
-        titleText = loc.inner_text().strip()
-    except PWTimeoutError:
-        # 2) Minimal fallback: any span that contains "m²"
-        # (keeps things robust across minor class/name changes)
-        alt = page.locator("span", has_text=re.compile(r"\bm²\b")).first
+    titleText = (snapshot["title"] or "").strip() or None
+    if titleText is None:
+        loc = page.locator("span.css-v34a4n").first
         try:
-            alt.wait_for(state="attached", timeout=3000)
-            candidate = (alt.text_content() or "").strip()
-            if candidate:
-                titleText = candidate
+            # Not rendered yet: wait for it to be visible and read it
+            await loc.wait_for(state="visible")
+            titleText = (await loc.inner_text()).strip()
         except PWTimeoutError:
-            pass
+            # 2) Minimal fallback: any span that contains "m²"
+            # (keeps things robust across minor class/name changes)
+            alt = page.locator("span", has_text=_AREA_RE).first
+            try:
+                await alt.wait_for(state="attached", timeout=3000)
+                candidate = ((await alt.text_content()) or "").strip()
+                if candidate:
+                    titleText = candidate
+            except PWTimeoutError:
+                pass
 
     if not titleText:
         # If absolutely nothing matched, return None for title (and address later)
         titleText = None
 
     # 3) Address: find the first div.css-o9y6d5 containing a 4-digit ZIP, then slice from ZIP → end
-    addressText = None
-    addressDivs = page.locator("div.css-o9y6d5")
-
-    try:
-        count = addressDivs.count()  # number of matching divs (may be 0)
-        for i in range(count):
-            text = (addressDivs.nth(i).inner_text() or "").strip()
-            m = re.search(r"\b\d{4}\b", text)
-            if m:
-                addressText = text[m.start():].strip()
-                break
-    except PWTimeoutError:
-        # If count() or inner_text() times out (rare), leave addressText as None
-        pass
+    addressText = address_from_details(snapshot["details"])
 
     return titleText, addressText
 
 
-def process_listing(url: str, message_text: str, block_keywords: str) -> bool:
+async def _block_unneeded_requests(route) -> None:
+    request = route.request
+    if request.resource_type in LISTING_BLOCKED_RESOURCE_TYPES or any(
+        part in request.url for part in LISTING_BLOCKED_URL_PARTS
+    ):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def new_listing_context(browser) -> Tuple["BrowserContext", bool]:
     """
-    Open listing, check block keywords, then send message if allowed.
+    Creates the logged-in context every listing page opens in. It starts from
+    the session saved by an earlier listing if there is one, otherwise from
+    the configured cookies. Returns (context, started from the saved session).
     """
-    with sync_playwright() as p:
-        browser = p.chromium.launch(
-            headless=True,
-            args=["--no-sandbox", "--disable-dev-shm-usage"]
-        )
-        context = browser.new_context()
-        load_cookies_into_context(context)
-        page = context.new_page()
+    has_state = os.path.exists(STORAGE_STATE_PATH)
+    context = await browser.new_context(storage_state=STORAGE_STATE_PATH if has_state else None)
+    # Set once here; every page of the context inherits them
+    context.set_default_timeout(LISTING_ACTION_TIMEOUT_MS)
+    context.set_default_navigation_timeout(LISTING_NAV_TIMEOUT_MS)
+    await context.route("**/*", _block_unneeded_requests)
+    if not has_state:
+        await load_cookies_into_context(context)
+    return context, has_state
+
+async def launch_browser_context(playwright):
+    """
+    Launches the single Chromium instance and the context (see
+    new_listing_context) that every listing reuses for the lifetime of the process.
+    Returns (browser, context, started from the saved session).
+    """
+    browser = await playwright.chromium.launch(
+        headless=True,
+        args=["--no-sandbox", "--disable-dev-shm-usage"]
+    )
+    context, from_state = await new_listing_context(browser)
+    return browser, context, from_state
+
+# Returned by visit_listing when the page shows the session is logged out
+_LOGGED_OUT = None
+
+async def visit_listing(context, url: str, message_text: str, block_re: Optional[Pattern[str]]) -> Optional[bool]:
+    """
+    Open listing in a fresh page of context, check block keywords, then send
+    message if allowed. Returns _LOGGED_OUT (None) if the session is not logged in.
+    """
+    from playwright.async_api import TimeoutError as PWTimeoutError
+
+    page = await context.new_page()
+    try:
+        # Don't wait for every image/tracker ("load"); gate on the nodes the
+        # snapshot reads instead (the Contact click waits for its own button)
+        await page.goto(url, wait_until="domcontentloaded")
         try:
-            page.goto(url, wait_until="load", timeout=60000)
-            
-            if not cookies_are_valid(page):
-                print("[Playwright] Cookies are invalid or expired. Cannot proceed.")
-                notify_discord("expired_session", url, "Failed to login. Cookies are invalid or expired")
-                return False
-
-
-            # Block keywords check
-            foundBlockedKeyword, keyword = page_contains_block_keywords(page, block_keywords) 
-            if foundBlockedKeyword:
-                print(f"[Playwright] Block keyword matched '{keyword}' — skipping this listing.")
-                notify_discord("blocked", url, f"{keyword}")
-                return True  # treat skip as handled
-
-            
-            shortTermSuspected = False
-            termDetector = page_contains_short_term(page, months_threshold=8)
-            if (termDetector and termDetector.get("is_short_term")):
-                if (termDetector.get("confidence")=="high"):
-                    notificationMessage = f"Short term ({termDetector.confidence}). Reason: {termDetector.reason}"
-                    print(f"[Playwright] Short term {notificationMessage} — skipping this listing.")
-                    notify_discord("short_term", url, f"{notificationMessage}")
-                    return True  # treat skip as handled
-                else:
-                    # If low confidence, still allow to contact but notify that there is a suspected short term
-                    shortTermSuspected = True
-
-            # Try to contact
-            ok = click_contact_and_send(page, message_text, shortTermSuspected)
-            return ok
-        except Exception as e:
-            print(f"[Playwright] Failed on {url}: {e}")
-            return False
-        finally:
-            browser.close()
+            await page.locator(_LISTING_CONTENT_SELECTOR).first.wait_for(timeout=10000)
+        except PWTimeoutError:
+            # Nothing rendered (removed listing, layout change): the checks below still run
+            pass
+
+        snapshot = await read_listing_snapshot(page)
+
+        if not cookies_are_valid(snapshot):
+            return _LOGGED_OUT
+
+        # Block keywords and short-term checks
+        kind, detail, shortTermSuspected = _skip_decision(snapshot["details"], snapshot["terms"], block_re)
+        if kind is not None:
+            await notify_skipped_listing(url, kind, detail, "[Playwright]")
+            return True  # treat skip as handled
+
+        # Try to contact
+        ok = await click_contact_and_send(page, message_text, shortTermSuspected, snapshot)
+        if ok:
+            # A confirmed logged-in session: keep it for the next start (saved here,
+            # not on shutdown, since `docker stop` kills the process outright)
+            await save_storage_state(context)
+        return ok
+    except Exception as e:
+        print(f"[Playwright] Failed on {url}: {e}")
+        return False
+    finally:
+        await page.close()
+
+async def process_listing(get_context, url: str, message_text: str, block_re: Optional[Pattern[str]]) -> bool:
+    """
+    Runs the HTTP prefilter, then visit_listing in the shared context.
+    get_context() returns that context, launching the browser on first use;
+    get_context(stale) replaces a logged-out context restored from the saved
+    session with one built from the cookies (None if it can't be replaced).
+    """
+    # Cheap HTTP pass first: blocked / clearly short-term listings never open a
+    # page, and a batch where all of them are skipped never launches Chromium
+    if await prefilter_listing(url, block_re):
+        return True
+
+    context = await get_context()
+    ok = await visit_listing(context, url, message_text, block_re)
+    if ok is _LOGGED_OUT:
+        # The saved session expired: retry once with the cookies
+        stale, context = context, await get_context(context)
+        if context is not None:
+            ok = await visit_listing(context, url, message_text, block_re)
+            # Replaced: closed once the last listing still using it is done
+            if not stale.pages:
+                await stale.close()
+    if ok is _LOGGED_OUT:
+        print("[Playwright] Cookies are invalid or expired. Cannot proceed.")
+        await notify_discord_async("expired_session", url, "Failed to login. Cookies are invalid or expired")
+        return False
+    return ok
 
 # =========================
 # MAIN EMAIL → LISTING LOOP
 # =========================
 
+# Listing URLs already handled (sent, already contacted, or skipped) → time
+# handled, kept in insertion order so the oldest can be evicted once
+# PROCESSED_URLS_MAX is hit
+_PROCESSED_URLS: Dict[str, float] = {}
+
+def load_processed_urls(path: str = PROCESSED_URLS_PATH) -> None:
+    """
+    Restores the handled-URL cache saved by a previous run (if any),
+    dropping entries older than PROCESSED_URLS_TTL_SECONDS.
+    """
+    try:
+        with open(path, "rb") as f:
+            saved = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return
+    if isinstance(saved, list):
+        # Files written before timestamps were kept: a plain list of URLs
+        saved = dict.fromkeys(saved, time.time())
+    cutoff = time.time() - PROCESSED_URLS_TTL_SECONDS
+    for url, handled_at in list(saved.items())[-PROCESSED_URLS_MAX:]:
+        if handled_at >= cutoff:
+            _PROCESSED_URLS[url] = handled_at
+
+def save_processed_urls(path: str = PROCESSED_URLS_PATH) -> None:
+    try:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(_PROCESSED_URLS))
+    except OSError:
+        pass
+
+def remember_processed_url(url: str) -> None:
+    _PROCESSED_URLS.pop(url, None)
+    _PROCESSED_URLS[url] = time.time()
+    while len(_PROCESSED_URLS) > PROCESSED_URLS_MAX:
+        del _PROCESSED_URLS[next(iter(_PROCESSED_URLS))]
+
+def is_processed_url(url: str) -> bool:
+    handled_at = _PROCESSED_URLS.get(url)
+    return handled_at is not None and time.time() - handled_at < PROCESSED_URLS_TTL_SECONDS
+
 def extract_listing_links_from_message_html(html: str) -> List[str]:
     """
     Wrapper to hook in your layout-specific extraction.
     """
     return extract_listing_links_from_email_html(html)
 
-def process_new_emails_once(service, sender_email: str, message_text: str, block_keywords: str) -> None:
+async def process_listings(get_context, urls: List[str], message_text: str, block_re: Optional[Pattern[str]]) -> None:
+    """
+    Runs process_listing for several URLs at once, at most
+    LISTING_CONCURRENCY pages in flight, so their network waits overlap.
+    """
+    sem = asyncio.Semaphore(LISTING_CONCURRENCY)
+
+    async def _bounded(url: str) -> None:
+        async with sem:
+            print(f"[Bot] Processing listing: {url}")
+            ok = await process_listing(get_context, url, message_text, block_re)
+            if ok:
+                remember_processed_url(url)
+
+    await asyncio.gather(*(_bounded(url) for url in urls))
+
+async def process_new_emails_once(service, get_context, sender_email: str, message_text: str, block_re: Optional[Pattern[str]]) -> bool:
+    """
+    Returns False if unread emails may still be waiting: they could not be
+    fetched (and were left unread), or the search returned a full page. The
+    caller should then search again on the next pass; the history API would
+    not report those older emails again.
+    """
     try:
         msgs = list_unread_boligportal_messages(service, sender_email)
         if not msgs:
             print("[Bot] No emails found.")
-            return
+            return True
 
         print(f"[Bot] Found {len(msgs)} email(s).")
-        for m in msgs:
-            msg_id = m["id"]
-            try:
-                html = fetch_message_html(service, msg_id)
-                if not html:
-                    print(f"[Bot] Empty/unsupported email body for {msg_id}")
-                    continue
-
-                links = extract_listing_links_from_message_html(html)
-                if not links:
-                    print(f"[Bot] No boligportal links in email {msg_id}")
-                    continue
-
-                print(f"[Bot] Found {len(links)} unique link(s) in email {msg_id}.")
-                for url in links:
-                    if "boligportal.dk" not in url:
+        msg_ids = [m["id"] for m in msgs]
+        try:
+            html_by_id = fetch_messages_html(service, msg_ids)
+        except Exception as e:
+            # Transport errors too (timeout, DNS, SSL): nothing was read, so nothing is marked read
+            print(f"[Bot] Failed to fetch emails: {e}")
+            return False
+        try:
+            # Listings of every email go into one pool, so pages of different
+            # emails load concurrently (and a link in two emails is visited once)
+            todo: Dict[str, None] = {}
+            for msg_id in msg_ids:
+                try:
+                    html = html_by_id.get(msg_id)
+                    if not html:
+                        print(f"[Bot] Empty/unsupported email body for {msg_id}")
                         continue
-                    print(f"[Bot] Processing listing: {url}")
-                    ok = process_listing(url, message_text, block_keywords)
 
-            except Exception as e:
-                print(f"[Bot] Error while handling email {msg_id}: {e}")
+                    links = extract_listing_links_from_message_html(html)
+                    if not links:
+                        print(f"[Bot] No boligportal links in email {msg_id}")
+                        continue
+
+                    print(f"[Bot] Found {len(links)} unique link(s) in email {msg_id}.")
+                    for url in links:
+                        if "boligportal.dk" not in url:
+                            continue
+                        if is_processed_url(url):
+                            print(f"[Bot] Already handled, skipping: {url}")
+                            continue
+                        todo[url] = None
+
+                except Exception as e:
+                    print(f"[Bot] Error while handling email {msg_id}: {e}")
 
-            finally:
-                # mark as read, even if already contacted, blocked, cookies expired, or errors
+            if todo:
                 try:
-                    service.users().messages().modify(
-                        userId="me",
-                        id=msg_id,
-                        body={"removeLabelIds": ["UNREAD"]}
-                    ).execute()
-                except HttpError as he:
-                    print(f"[Bot] Failed to mark email {msg_id} as read: {he}")
+                    await process_listings(get_context, list(todo), message_text, block_re)
+                except Exception as e:
+                    print(f"[Bot] Error while processing listings: {e}")
+                # Persist now: docker stop may end the process without running atexit
+                if any(is_processed_url(url) for url in todo):
+                    save_processed_urls()
+        finally:
+            # mark as read, even if already contacted, blocked, cookies expired, or errors
+            mark_messages_read(service, msg_ids)
+        return len(msgs) < GMAIL_LIST_PAGE_SIZE
     except HttpError as he:
         print(f"[Bot] Gmail API error: {he}")
+        return False
 
-def main():
+async def run():
     cfg = get_config()
     sender = cfg["EMAIL_FROM"]
     message_text = cfg["PREWRITTEN_MESSAGE"]
-    block_keywords = cfg.get("BLOCK_KEYWORDS", "")
+    block_re = compile_block_keywords(cfg.get("BLOCK_KEYWORDS", ""))
 
     print("Starting Gmail → BoligPortal bot…")
     print(f"- Waiting for emails from: {sender}")
     creds = load_gmail_credentials()
     service = get_gmail_service(creds)
 
-    while True:
-        if not ensure_gmail_token(creds):
-            break
+    load_processed_urls()
+    # Fallback only: each batch already saves what it handled
+    atexit.register(save_processed_urls)
+
+    subscriber = create_pubsub_subscriber()
+    watch_expires_at = start_gmail_watch(service) if subscriber else 0.0
+
+    from playwright.async_api import async_playwright
+
+    # One browser + context for the whole run; each listing only opens a page.
+    # Chromium is only launched once a listing survives the HTTP prefilter.
+    async with async_playwright() as playwright:
+        browser = context = None
+        from_state = False
+        # Listings run concurrently: only the first caller may launch or replace
+        launch_lock = asyncio.Lock()
+
+        async def get_context(stale=None):
+            nonlocal browser, context, from_state
+            async with launch_lock:
+                if context is None:
+                    browser, context, from_state = await launch_browser_context(playwright)
+                elif context is stale:
+                    if not from_state:
+                        # Already built from the cookies: those are logged out too
+                        return None
+                    # The saved session is logged out: rebuild from the cookies
+                    discard_storage_state()
+                    context, from_state = await new_listing_context(browser)
+            return context
+
+        history_id = None
         try:
-            process_new_emails_once(service, sender, message_text, block_keywords)
-        except HttpError as he:
-            # If unauthorized, notify + stop so you can re-auth
-            status = getattr(he, "status_code", None)
-            if status == 401:
-                msg = "Gmail 401 Unauthorized: delete token.json and re-authorize."
-                print("[Gmail]", msg)
-                notify_discord("expired_session", "", extra=msg)
-                break
-            else:
-                print(f"[Gmail] API error: {he}")
-        time.sleep(POLL_SECONDS)
+            while True:
+                if not ensure_gmail_token(creds):
+                    break
+                try:
+                    # First pass always searches; later passes only when the
+                    # history API reports newly added unread mail
+                    changed = True
+                    if history_id is None:
+                        history_id = get_history_id(service)
+                    else:
+                        changed, history_id = has_new_unread_messages(service, history_id)
+                    if changed:
+                        if not await process_new_emails_once(service, get_context, sender, message_text, block_re):
+                            # Emails left unread (fetch failed or more than one page):
+                            # the history gate would not report them again
+                            history_id = None
+                    else:
+                        print("[Bot] No new emails.")
+                except HttpError as he:
+                    # If unauthorized, notify + stop so you can re-auth
+                    status = getattr(he, "status_code", None)
+                    if status == 401:
+                        msg = "Gmail 401 Unauthorized: delete token.json and re-authorize."
+                        print("[Gmail]", msg)
+                        notify_discord("expired_session", "", extra=msg)
+                        break
+                    else:
+                        print(f"[Gmail] API error: {he}")
+                if subscriber and time.time() > watch_expires_at - GMAIL_WATCH_RENEW_MARGIN_SECONDS:
+                    # Renewal, or a retry after a failed watch call
+                    watch_expires_at = start_gmail_watch(service)
+                # Wake up as soon as Gmail reports a change instead of polling;
+                # without an active watch, or if the pull fails, poll this cycle
+                pushed = None
+                if subscriber and watch_expires_at:
+                    pushed = await asyncio.to_thread(wait_for_gmail_push, subscriber, GMAIL_PUSH_MAX_WAIT_SECONDS)
+                if pushed is None:
+                    await asyncio.sleep(POLL_SECONDS)
+        finally:
+            if browser is not None:
+                await browser.close()
+
+def main():
+    asyncio.run(run())
 
 if __name__ == "__main__":
     main()
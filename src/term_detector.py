@@ -1,114 +1,118 @@
 ﻿# -*- coding: utf-8 -*-
-import os, re
-from datetime import datetime
+import calendar, os, re
+from datetime import date, datetime
+from functools import lru_cache
 from zoneinfo import ZoneInfo
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Match, Pattern
 
 # ===== Config =====
 SHORT_TERM_MONTHS_DEFAULT = 6  # override with env SHORT_TERM_MONTHS
 
+# TERM_DETECTOR_RE2=1 compiles the cue words searched over the whole text with
+# google-re2 (if installed) for linear-time matching. The slice, date and
+# duration patterns stay on re: on short inputs RE2's per-call overhead wins.
+_cue_re = re
+if os.getenv("TERM_DETECTOR_RE2") == "1":
+    try:
+        import re2 as _cue_re
+    except ImportError:
+        pass
+
 # ===== Helpers =====
 _CPH = ZoneInfo("Europe/Copenhagen")
-MONTHS_DA_FULL = ["januar","februar","marts","april","maj","juni","juli","august","september","oktober","november","december"]
-MONTHS_EN_FULL = ["january","february","march","april","may","june","july","august","september","october","november","december"]
 MONTHS_DA_ABBR = ["jan","feb","mar","apr","maj","jun","jul","aug","sep","okt","nov","dec"]
 MONTHS_EN_ABBR = ["jan","feb","mar","apr","may","jun","jul","aug","sep","oct","nov","dec"]
 
-MONTH_NAME_TO_NUM = {m:i+1 for i,m in enumerate(MONTHS_DA_FULL)}
-MONTH_NAME_TO_NUM.update({m:i+1 for i,m in enumerate(MONTHS_EN_FULL)})
-MONTH_NAME_TO_NUM.update({m:i+1 for i,m in enumerate(MONTHS_DA_ABBR)})
-MONTH_NAME_TO_NUM.update({m:i+1 for i,m in enumerate(MONTHS_EN_ABBR)})
+# Keyed by the three-letter abbreviation only: every DA/EN full month name
+# ("marts", "october", ...) starts with its abbreviation
+MONTH_NAME_TO_NUM = {m: i + 1 for abbrs in (MONTHS_DA_ABBR, MONTHS_EN_ABBR) for i, m in enumerate(abbrs)}
 
 def _now_cph() -> datetime:
     return datetime.now(_CPH)
 
-def _months_between(a: datetime, b: datetime) -> float:
+def _months_between(a: date, b: date) -> float:
+    # Calendar months plus the day remainder, so 1/8 → 1/2 is exactly 6 months
+    # (plain int arithmetic; works on dates and on the tz-aware "now" alike)
     return (b.year - a.year) * 12 + (b.month - a.month) + (b.day - a.day) / 30.0
 
 def _to_year(y: int) -> int:
     return y + 2000 if y < 100 else y
 
-def _parse_numeric_date(day: int, mon: int, year: int) -> Optional[datetime]:
-    try:
-        return datetime(_to_year(year), mon, day, tzinfo=_CPH)
-    except ValueError:
+# Longest day of each month (index 0 unused); Feb 29 is checked against the year
+_MONTH_DAYS: Tuple[int, ...] = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+def _parse_numeric_date(day: int, mon: int, year: int) -> Optional[date]:
+    # Plain calendar dates: only "now" needs the Copenhagen time zone.
+    # Range-checked up front so rejected D/M orders don't raise ValueError.
+    year = _to_year(year)
+    if not (1 <= mon <= 12 and 1 <= day <= _MONTH_DAYS[mon]):
+        return None
+    if mon == 2 and day == 29 and not calendar.isleap(year):
         return None
+    return date(year, mon, day)
 
 # ---- Month lookups ----
 def _mon_from_name(name: str) -> Optional[int]:
-    if not name:
-        return None
-    s = name.strip().lower()
-    return MONTH_NAME_TO_NUM.get(s[:3]) or MONTH_NAME_TO_NUM.get(s)
+    # Month words come from DATE_PATTERN: lowercase and starting with a known
+    # three-letter abbreviation, so one probe on that prefix resolves them
+    return MONTH_NAME_TO_NUM.get(name[:3])
 
 # ---- Ordinal helpers ----
-_ORDINAL = re.compile(r"^(\d{1,2})(?:st|nd|rd|th)?\.?$", re.I)  # 2, 2nd, 2., 2nd.
+_ORDINAL = re.compile(r"^(\d{1,2})(?:st|nd|rd|th)?\.?$")  # 2, 2nd, 2., 2nd.
 
 def _parse_ordinal_day(token: str) -> Optional[int]:
     m = _ORDINAL.match(token.strip())
     return int(m.group(1)) if m else None
 
 # ===== Patterns (ANY-ORDER) =====
-NUMERIC_DMY = re.compile(r"\b(\d{1,2})[./-](\d{1,2})[./-](\d{2,4})\b")  # D-M-Y or M-D-Y (resolved later)
-NUMERIC_YMD_ISO = re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b")        # 2025-09-02
-
-# Textual variants (DA/EN months), any order with optional year and ordinals.
-TEXTUAL_DAY_MONTH_YEAROPT = re.compile(
-    r"\b(\d{1,2}(?:st|nd|rd|th)?\.?)\s+([A-Za-zæøåÆØÅ]+)(?:\s+(\d{2,4}))?\b"
-)
-TEXTUAL_MONTH_DAY_YEAROPT = re.compile(
-    r"\b([A-Za-zæøåÆØÅ]+)\s+(\d{1,2}(?:st|nd|rd|th)?\.?)(?:,)?(?:\s+(\d{2,4}))?\b"
-)
-TEXTUAL_MONTH_YEAR = re.compile(
-    r"\b([A-Za-zæøåÆØÅ]+)\s+(\d{2,4})\b"
+# All patterns run on the lowercased text, so none needs re.I
+# A word counts as a month when its first three letters name one (as in _mon_from_name)
+_MONTH_WORD = "(?:" + "|".join(MONTH_NAME_TO_NUM) + ")[a-zæøå]*"
+_DAY_TOKEN = r"\d{1,2}(?:st|nd|rd|th)?\.?"  # 2, 2nd, 2., 2nd.
+
+# Every date shape (DA/EN months, optional year and ordinals) in one
+# alternation, so the text is scanned once and matches come out in order.
+# Each shape is a named group directly followed by its parts.
+DATE_PATTERN = re.compile(
+    r"\b(?:"
+    r"(?P<iso>(\d{4})-(\d{1,2})-(\d{1,2}))"                 # 2025-09-02
+    r"|(?P<numeric>(\d{1,2})[./-](\d{1,2})[./-](\d{2,4}))"  # D-M-Y or M-D-Y (resolved later)
+    r"|(?P<day_month>(" + _DAY_TOKEN + r")\s+(" + _MONTH_WORD + r")(?:\s+(\d{2,4}))?)"
+    r"|(?P<month_day>(" + _MONTH_WORD + r")\s+(" + _DAY_TOKEN + r"),?(?:\s+(\d{2,4}))?)"
+    r"|(?P<month_year>(" + _MONTH_WORD + r")\s+(\d{2,4}))"
+    r")\b"
 )
 
-# explicit duration (months / weeks)
-DURATION_PATTERNS = [
-    r"\b(\d{1,2})\s*[-\s]?(?:months?|mos?|mths?)\b",
-    r"\b(\d{1,2})\s*(?:mdr\.?|måneder)\b",
-    r"\b(\d{1,2})\s*(?:weeks?|uger)\b",  # weeks ~ n/4 months
+# Every duration and date pattern needs a digit
+_DIGIT = re.compile(r"\d")
+
+# explicit duration (months / weeks): (compiled pattern, counts weeks)
+DURATION_PATTERNS: List[Tuple[Pattern[str], bool]] = [
+    (re.compile(r"\b(\d{1,2})\s*[-\s]?(?:months?|mos?|mths?)\b"), False),
+    (re.compile(r"\b(\d{1,2})\s*(?:mdr\.?|måneder)\b"), False),
+    (re.compile(r"\b(\d{1,2})\s*(?:weeks?|uger)\b"), True),  # weeks ~ n/4 months
 ]
 
 # cues
-ENDDATE_CUES = re.compile(r"\b(indtil|until|ending|ends|udløber|slutter|senest)\b", re.I)
-RANGE_TERMS = re.compile(r"\b(i\s+perioden|perioden|tidsrum\w*|fra|from)\b", re.I)
-BINDING_TERMS = re.compile(r"\b(bindingsperiode|binding|ubrydelig\s+lejeperiode|min(?:\.|imum)?\s+binding)\b", re.I)
-CONNECTOR = re.compile(r"\b(to|til|indtil|until|through|thru)\b|[-–—]\s*", re.I)
-OR_TERMS = re.compile(r"\b(or|eller)\b", re.I)  # NEW: treat as alternatives, not ranges
-STARTDATE_CUES = re.compile(r"\b(ledigt\s+fra|available\s+from|from|fra)\b", re.I)
-
-SHORTTERM_CUES = re.compile(
-    r"\b(temporary|short[-\s]?term|sublet|sublease|midlertidig|midlertidigt|korttids|fremleje|fremlejet|lejlighedshotel)\b",
-    re.I
+ENDDATE_CUES = _cue_re.compile(r"\b(indtil|until|ending|ends|udløber|slutter|senest)\b")
+RANGE_TERMS = re.compile(r"\b(i\s+perioden|perioden|tidsrum\w*|fra|from)\b")
+BINDING_TERMS = re.compile(r"\b(bindingsperiode|binding|ubrydelig\s+lejeperiode|min(?:\.|imum)?\s+binding)\b")
+CONNECTOR = re.compile(r"\b(to|til|indtil|until|through|thru)\b|[-–—]\s*")
+_GAP_ONLY = re.compile(r"[\s,.;:()/\-–—]*")  # nothing but spacing/punctuation
+OR_TERMS = re.compile(r"\b(or|eller)\b")  # NEW: treat as alternatives, not ranges
+STARTDATE_CUES = _cue_re.compile(r"\b(ledigt\s+fra|available\s+from|from|fra)\b")
+
+SHORTTERM_CUES = _cue_re.compile(
+    r"\b(temporary|short[-\s]?term|sublet|sublease|midlertidig|midlertidigt|korttids|fremleje|fremlejet|lejlighedshotel)\b"
 )
 
 # ===== Parsers =====
-def _try_parse_numeric_anyorder(a: str, b: str, c: str) -> Optional[datetime]:
-    """Try DMY first (EU/DK default), then MDY; also accept YMD if 'a' looks like a year."""
-    if len(a) == 4:
-        dt = _parse_numeric_date(int(c), int(b), int(a))
-        if dt:
-            return dt
+def _try_parse_numeric_anyorder(a: str, b: str, c: str) -> Optional[date]:
+    """Try DMY first (EU/DK default), then MDY. ISO Y-M-D has its own DATE_PATTERN shape."""
+    first, second, year = int(a), int(b), int(c)
+    return _parse_numeric_date(first, second, year) or _parse_numeric_date(second, first, year)
 
-    d1, m1, y1 = int(a), int(b), int(c)
-
-    dt = _parse_numeric_date(d1, m1, y1)  # D-M-Y
-    if dt:
-        return dt
-
-    dt = _parse_numeric_date(m1, d1, y1)  # M-D-Y
-    if dt:
-        return dt
-
-    if len(a) == 4:
-        dt = _parse_numeric_date(int(c), int(b), int(a))
-        if dt:
-            return dt
-
-    return None
-
-def _parse_textual_day_month_yearopt(day_token: str, mon_name: str, year_str: Optional[str]) -> Tuple[Optional[datetime], bool]:
+def _parse_textual_day_month_yearopt(day_token: str, mon_name: str, year_str: Optional[str], default_year: int) -> Tuple[Optional[date], bool]:
     mon = _mon_from_name(mon_name)
     if not mon:
         return None, False
@@ -116,10 +120,10 @@ def _parse_textual_day_month_yearopt(day_token: str, mon_name: str, year_str: Op
     if day is None:
         return None, False
     had_year = year_str is not None
-    year = int(year_str) if year_str else _now_cph().year
+    year = int(year_str) if year_str else default_year
     return _parse_numeric_date(day, mon, year), had_year
 
-def _parse_textual_month_day_yearopt(mon_name: str, day_token: str, year_str: Optional[str]) -> Tuple[Optional[datetime], bool]:
+def _parse_textual_month_day_yearopt(mon_name: str, day_token: str, year_str: Optional[str], default_year: int) -> Tuple[Optional[date], bool]:
     mon = _mon_from_name(mon_name)
     if not mon:
         return None, False
@@ -127,76 +131,50 @@ def _parse_textual_month_day_yearopt(mon_name: str, day_token: str, year_str: Op
     if day is None:
         return None, False
     had_year = year_str is not None
-    year = int(year_str) if year_str else _now_cph().year
+    year = int(year_str) if year_str else default_year
     return _parse_numeric_date(day, mon, year), had_year
 
-def _parse_textual_month_year(mon_name: str, year_str: str) -> Optional[datetime]:
+def _parse_textual_month_year(mon_name: str, year_str: str) -> Optional[date]:
     mon = _mon_from_name(mon_name)
     if not mon:
         return None
     return _parse_numeric_date(28, mon, int(year_str))  # assume late-month
 
 # ===== Extraction =====
-def _extract_all_dates(text: str) -> List[datetime]:
-    dates: List[datetime] = []
-
-    for y, m, d in NUMERIC_YMD_ISO.findall(text):
-        dt = _parse_numeric_date(int(d), int(m), int(y))
-        if dt: dates.append(dt)
-
-    for a, b, c in NUMERIC_DMY.findall(text):
-        dt = _try_parse_numeric_anyorder(a, b, c)
-        if dt: dates.append(dt)
-
-    for day, mon, y in TEXTUAL_DAY_MONTH_YEAROPT.findall(text):
-        dt, _had_year = _parse_textual_day_month_yearopt(day, mon, y if y else None)
-        if dt: dates.append(dt)
-    for mon, day, y in TEXTUAL_MONTH_DAY_YEAROPT.findall(text):
-        dt, _had_year = _parse_textual_month_day_yearopt(mon, day, y if y else None)
-        if dt: dates.append(dt)
-    for mon, y in TEXTUAL_MONTH_YEAR.findall(text):
-        dt = _parse_textual_month_year(mon, y)
-        if dt: dates.append(dt)
-
-    return sorted({dt.isoformat(): dt for dt in dates}.values())
-
-def _extract_date_spans(text: str) -> List[Tuple[int, int, datetime, bool]]:
-    """Return (start, end, datetime, had_year) for every detected date."""
-    spans: List[Tuple[int,int,datetime,bool]] = []
-
-    for m in NUMERIC_YMD_ISO.finditer(text):
-        y, mo, d = m.groups()
-        dt = _parse_numeric_date(int(d), int(mo), int(y))
-        if dt: spans.append((m.start(), m.end(), dt, True))
-
-    for m in NUMERIC_DMY.finditer(text):
-        a, b, c = m.groups()
-        dt = _try_parse_numeric_anyorder(a, b, c)
-        if dt: spans.append((m.start(), m.end(), dt, True))  # numeric has a year
-
-    for m in TEXTUAL_DAY_MONTH_YEAROPT.finditer(text):
-        day, mon, y = m.groups()
-        dt, had_year = _parse_textual_day_month_yearopt(day, mon, y if y else None)
-        if dt: spans.append((m.start(), m.end(), dt, had_year))
-
-    for m in TEXTUAL_MONTH_DAY_YEAROPT.finditer(text):
-        mon, day, y = m.groups()
-        dt, had_year = _parse_textual_month_day_yearopt(mon, day, y if y else None)
+def _extract_date_spans(text: str, default_year: int) -> List[Tuple[int, int, date, bool]]:
+    """
+    Return (start, end, date, had_year) for every detected date, in text order.
+    Dates written without a year get default_year (the caller's "now").
+    """
+    spans: List[Tuple[int,int,date,bool]] = []
+
+    for m in DATE_PATTERN.finditer(text):
+        # The shape's group closes last, so lastindex points at it and its parts follow
+        kind, i = m.lastgroup, m.lastindex
+        if kind == "iso":
+            y, mo, d = m.group(i + 1, i + 2, i + 3)
+            dt, had_year = _parse_numeric_date(int(d), int(mo), int(y)), True
+        elif kind == "numeric":
+            dt, had_year = _try_parse_numeric_anyorder(*m.group(i + 1, i + 2, i + 3)), True
+        elif kind == "day_month":
+            day, mon, y = m.group(i + 1, i + 2, i + 3)
+            dt, had_year = _parse_textual_day_month_yearopt(day, mon, y, default_year)
+        elif kind == "month_day":
+            mon, day, y = m.group(i + 1, i + 2, i + 3)
+            dt, had_year = _parse_textual_month_day_yearopt(mon, day, y, default_year)
+        else:
+            mon, y = m.group(i + 1, i + 2)
+            dt, had_year = _parse_textual_month_year(mon, y), True
         if dt: spans.append((m.start(), m.end(), dt, had_year))
 
-    for m in TEXTUAL_MONTH_YEAR.finditer(text):
-        mon, y = m.groups()
-        dt = _parse_textual_month_year(mon, y)
-        if dt: spans.append((m.start(), m.end(), dt, True))
-
-    spans.sort(key=lambda x: x[0])
     return spans
 
-def _first_duration_months(tl: str):
-    for pat in DURATION_PATTERNS:
-        for m in re.finditer(pat, tl):
+def _first_duration_months(tl: str) -> Tuple[Optional[float], Optional[Match[str]]]:
+    for pat, is_weeks in DURATION_PATTERNS:
+        m = pat.search(tl)
+        if m:
             n = float(m.group(1))
-            months = n / 4.0 if ("week" in pat or "uger" in pat) else n
+            months = n / 4.0 if is_weeks else n
             return months, m
     return None, None
 
@@ -208,7 +186,13 @@ def is_short_term_heuristic(
 ) -> dict:
     months_threshold = months_threshold or int(os.getenv("SHORT_TERM_MONTHS", SHORT_TERM_MONTHS_DEFAULT))
     now = now or _now_cph()
+    # The verdict only depends on the calendar day of "now", so the same listing
+    # text (prefilter + listing page, later polls) is classified once per day.
+    # Copied so callers can't mutate the cached dict.
+    return dict(_classify(text, months_threshold, now.date()))
 
+@lru_cache(maxsize=1024)
+def _classify(text: str, months_threshold: int, now: date) -> dict:
     t = " ".join((text or "").split())
     tl = t.lower()
 
@@ -221,8 +205,11 @@ def is_short_term_heuristic(
     else:
         cue_only = False
 
+    # Without a digit there is no duration or date to find: only the cue words decide
+    has_digit = _DIGIT.search(tl) is not None
+
     # 1) Explicit duration — but guard for binding context nearby
-    dur, dur_match = _first_duration_months(tl)
+    dur, dur_match = _first_duration_months(tl) if has_digit else (None, None)
     if dur is not None:
         # binding near the duration?
         binding_nearby = False
@@ -248,66 +235,66 @@ def is_short_term_heuristic(
         # duration > threshold → keep checking dates
 
     # 2) Dates: detect ranges or single end dates
-    dates = _extract_all_dates(t)
-    date_spans = _extract_date_spans(t)
-
-    # 2a) Range detection between two date spans
-    if len(date_spans) >= 2:
-        for i in range(len(date_spans) - 1):
-            s1, e1, d1, y1 = date_spans[i]
-            s2, e2, d2, y2 = date_spans[i + 1]
-            between = t[e1:s2]
-            before_first = t[max(0, s1 - 48): s1]
-
-            # NEW: if there's "or/eller" between the two dates, treat as alternatives, not a range
-            if OR_TERMS.search(between):
+    date_spans = _extract_date_spans(tl, now.year) if has_digit else []
+
+    # 2a) Range detection between two adjacent date spans
+    for (s1, e1, d1, y1), (s2, e2, d2, y2) in zip(date_spans, date_spans[1:]):
+        between = tl[e1:s2]
+
+        # NEW: if there's "or/eller" between the two dates, treat as alternatives, not a range
+        if OR_TERMS.search(between):
+            continue
+
+        # A connector, or only punctuation between the dates after a range term
+        # ("i perioden 1/8 2025 15/1 2026"); the look-behind is only read if needed
+        if CONNECTOR.search(between) or (
+            len(between) <= 24 and _GAP_ONLY.fullmatch(between) is not None
+            and RANGE_TERMS.search(tl[max(0, s1 - 48): s1]) is not None
+        ):
+            # Year inference: if exactly one side lacked an explicit year, project it from the other side.
+            # Rebuilt through _parse_numeric_date, so a 29 Feb the other year lacks drops the pair
+            if y1 and not y2:
+                d2 = _parse_numeric_date(d2.day, d2.month, d1.year)
+            elif y2 and not y1:
+                d1 = _parse_numeric_date(d1.day, d1.month, d2.year)
+            if d1 is None or d2 is None:
                 continue
 
-            connector_between = CONNECTOR.search(between) is not None
-            just_gap_between = len(between) <= 24 and re.fullmatch(r"[\s,.;:()/\-–—]*", between) is not None
-            range_hint_before = RANGE_TERMS.search(before_first) is not None
-
-            if connector_between or (just_gap_between and range_hint_before):
-                # Year inference: if exactly one side lacked an explicit year, project it from the other side
-                if y1 and not y2:
-                    d2 = d2.replace(year=d1.year)
-                elif y2 and not y1:
-                    d1 = d1.replace(year=d2.year)
-
-                start, end = (d1, d2) if d1 <= d2 else (d2, d1)
-                range_months = _months_between(start, end)
-                if range_months <= months_threshold:
-                    return {
-                        "is_short_term": True,
-                        "reason": f"Date range {start.date()} → {end.date()} (~{range_months:.1f} months ≤ {months_threshold})",
-                        "end_date": end.isoformat(),
-                        "confidence": "high",
-                    }
-                # longer than threshold: keep checking single end-date below
-                break  # only consider the first adjacent pair
+            start, end = (d1, d2) if d1 <= d2 else (d2, d1)
+            range_months = _months_between(start, end)
+            if range_months <= months_threshold:
+                return {
+                    "is_short_term": True,
+                    "reason": f"Date range {start} → {end} (~{range_months:.1f} months ≤ {months_threshold})",
+                    "end_date": end.isoformat(),
+                    "confidence": "high",
+                }
+            # longer than threshold: keep checking single end-date below
+            break  # only the first adjacent pair that forms a range counts
 
     # 2b) Single explicit end cue + a date
-    if ENDDATE_CUES.search(tl) and dates:
-        end = dates[-1]
+    if date_spans and ENDDATE_CUES.search(tl):
+        # Only the latest date is needed here, so no sorted/deduped list is built
+        end = max(dt for _s, _e, dt, _y in date_spans)
         months_left = _months_between(now, end)
         if months_left <= months_threshold:
             return {
                 "is_short_term": True,
-                "reason": f"End date {end.date()} is ~{months_left:.1f} months from now ≤ {months_threshold}",
+                "reason": f"End date {end} is ~{months_left:.1f} months from now ≤ {months_threshold}",
                 "end_date": end.isoformat(),
                 "confidence": "med",
             }
         else:
             return {
                 "is_short_term": False,
-                "reason": f"End date {end.date()} is ~{months_left:.1f} months from now > {months_threshold}",
+                "reason": f"End date {end} is ~{months_left:.1f} months from now > {months_threshold}",
                 "end_date": end.isoformat(),
                 "confidence": "med",
             }
 
     # 2c) NEW: Handle "start only" availability like "ledigt fra 1. juli eller 1. august"
     # If there are dates but no range/end/duration, and a start cue is present, do NOT classify as short-term.
-    if STARTDATE_CUES.search(tl) and dates and dur is None and not ENDDATE_CUES.search(tl):
+    if date_spans and dur is None and STARTDATE_CUES.search(tl) and not ENDDATE_CUES.search(tl):
         return {
             "is_short_term": False,
             "reason": "Only a start/availability date detected (e.g., 'ledigt fra ...'); no end date or duration provided",
@@ -1,4 +1,5 @@
 ﻿
+import os
 from unittest import mock
 
 from src import discord_notifier
@@ -13,6 +14,19 @@ def test_load_variables_reads_key_value_pairs(tmp_path):
     assert result["DISCORD_WEBHOOK_URL"] == "https://example.com/webhook"
     assert result["FOO"] == "bar"
 
+def test_load_variables_rereads_file_after_change(tmp_path):
+    varfile = tmp_path / "variables.txt"
+    varfile.write_text("FOO=bar", encoding="utf-8")
+    assert discord_notifier.load_variables(str(varfile))["FOO"] == "bar"
+
+    varfile.write_text("FOO=baz", encoding="utf-8")
+    stat = varfile.stat()
+    os.utime(varfile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert discord_notifier.load_variables(str(varfile))["FOO"] == "baz"
+
+def test_load_variables_missing_file(tmp_path):
+    assert discord_notifier.load_variables(str(tmp_path / "missing.txt")) == {}
+
 def test_get_webhook_url_prefers_env(monkeypatch):
     monkeypatch.setenv("DISCORD_WEBHOOK_URL", "https://env-url")
     with mock.patch("src.discord_notifier.load_variables", return_value={"DISCORD_WEBHOOK_URL": "https://file-url"}):
@@ -31,7 +45,7 @@ def test_get_webhook_url_none_if_missing(monkeypatch):
         url = discord_notifier.get_webhook_url()
         assert url is None
 
-@mock.patch("src.discord_notifier.requests.post")
+@mock.patch("src.discord_notifier._SESSION.post")
 def test_notify_discord_success(mock_post, monkeypatch):
     # Patch WEBHOOK_URL to a dummy value
     monkeypatch.setattr(discord_notifier, "WEBHOOK_URL", "https://dummy")
@@ -43,7 +57,7 @@ def test_notify_discord_success(mock_post, monkeypatch):
     args, kwargs = mock_post.call_args
     assert kwargs["json"]["content"].startswith("✅")
 
-@mock.patch("src.discord_notifier.requests.post")
+@mock.patch("src.discord_notifier._SESSION.post")
 def test_notify_discord_failure_status(mock_post, monkeypatch):
     monkeypatch.setattr(discord_notifier, "WEBHOOK_URL", "https://dummy")
     mock_post.return_value.status_code = 400
@@ -57,7 +71,7 @@ def test_notify_discord_no_webhook(monkeypatch):
     result = discord_notifier.notify_discord("sent", "http://listing", "extra info")
     assert result is False
 
-@mock.patch("src.discord_notifier.requests.post", side_effect=Exception("Network error"))
+@mock.patch("src.discord_notifier._SESSION.post", side_effect=Exception("Network error"))
 def test_notify_discord_exception(mock_post, monkeypatch):
     monkeypatch.setattr(discord_notifier, "WEBHOOK_URL", "https://dummy")
     result = discord_notifier.notify_discord("sent", "http://listing", "extra info")
@@ -80,4 +94,10 @@ def test_notify_discord_exception(mock_post, monkeypatch):
 #     results.append(discord_notifier.notify_discord("unknown", test_url, "something else"))
 
 #     assert all(r is True for r in results[:-1])
-#     assert results[-1] is False
\ No newline at end of file
+#     assert results[-1] is False
+
+
+def test_webhook_post_is_retried_only_on_rate_limit():
+    retry = discord_notifier._SESSION.get_adapter("https://discord.com").max_retries
+    assert retry.is_retry("POST", 429, has_retry_after=True)
+    assert not retry.is_retry("POST", 503)
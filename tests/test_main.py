@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import base64
+import time
+from datetime import datetime, timedelta, timezone
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpMockSequence
+
+from src import main
+
+LISTING_A = "https://www.boligportal.dk/lejligheder/københavn/60m2-2-vaer-id-5412345"
+LISTING_B = "https://www.boligportal.dk/vaerelser/valby/12m2-1-vaer-id-5400001"
+LISTING_C = "https://www.boligportal.dk/lejligheder/frederiksberg/50m2-2-vaer-id-5399999"
+
+EMAIL_HTML = """<html><body><table><tbody>
+<tr><td><table><tbody><tr><td>Your search</td></tr>
+  <tr><td><a href="https://www.boligportal.dk/find?x=1">search</a></td></tr></tbody></table></td></tr>
+<tr><td>
+  <a href="https://t.awstrack.me/L0/https:%2F%2Fwww.boligportal.dk%2Flejligheder%2Fk%C3%B8benhavn%2F60m2-2-vaer-id-5412345%3Futm_source=mail/1/0100/abc=">A</a>
+  <a href="https://t.awstrack.me/L0/https:%2F%2Fwww.boligportal.dk%2Flejligheder%2Fk%C3%B8benhavn%2F60m2-2-vaer-id-5412345%3Futm_source=img/1/0100/abd=">img</a>
+  <a href="https://www.google.com/url?q=https://www.boligportal.dk/vaerelser/valby/12m2-1-vaer-id-5400001?foo=bar&amp;sa=D">B</a>
+  <a href="https://www.boligportal.dk/lejligheder/frederiksberg/50m2-2-vaer-id-5399999#top">C</a>
+  <a href="https://example.com/x">ext</a>
+</td></tr>
+<tr><td><table><tbody><tr><td><a href="https://www.boligportal.dk/find?all=1">See all results</a></td></tr></tbody></table></td></tr>
+</tbody></table></body></html>"""
+
+
+def test_extract_links_decodes_redirects_and_dedupes():
+    links = main.extract_listing_links_from_email_html(EMAIL_HTML)
+    assert links == [LISTING_A, LISTING_B, LISTING_C]
+
+
+def test_extract_links_dom_fallback_matches_regex_path(monkeypatch):
+    monkeypatch.setattr(main, "EMAIL_LINKS_DOM_ONLY", True)
+    links = main.extract_listing_links_from_email_html(EMAIL_HTML)
+    assert links == [LISTING_A, LISTING_B, LISTING_C]
+
+
+def test_extract_links_dom_fallback_tolerates_malformed_html(monkeypatch):
+    # Unclosed <tr>/<td> and an unquoted href, as seen in some digest emails
+    html = (
+        "<html><body><table><tbody><tr><td>Your search"
+        f'<tr><td><a href="{LISTING_C}">C</a><a href={LISTING_B}>B'
+        "<tr><td>See all results</table>"
+    )
+    monkeypatch.setattr(main, "EMAIL_LINKS_DOM_ONLY", True)
+    assert main.extract_listing_links_from_email_html(html) == [LISTING_C, LISTING_B]
+
+
+def test_extract_links_ignore_listing_links_outside_the_items_row():
+    # A "similar listings" footer links to another listing page
+    footer = "https://www.boligportal.dk/lejligheder/aarhus/40m2-1-vaer-id-5300000"
+    html = EMAIL_HTML.replace("See all results</a>", f'See all results</a> <a href="{footer}">Also</a>')
+    assert main.extract_listing_links_from_email_html(html) == [LISTING_A, LISTING_B, LISTING_C]
+    # Same answer when the tags are too broken for the scan and the DOM walk runs
+    assert main._extract_listing_links_by_regex(html.replace("</tr>", "", 1)) == []
+    assert main.extract_listing_links_from_email_html(html.replace("</tr>", "", 1)) == [LISTING_A, LISTING_B, LISTING_C]
+
+
+def test_extract_links_rented_out_returns_empty():
+    html = EMAIL_HTML.replace("Your search", "<div>The property has been marked as rented out</div>")
+    assert main.extract_listing_links_from_email_html(html) == []
+
+
+def test_processed_urls_round_trip_and_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "_PROCESSED_URLS", {})
+    monkeypatch.setattr(main, "PROCESSED_URLS_MAX", 2)
+    path = str(tmp_path / "processed_urls.json")
+
+    for url in (LISTING_A, LISTING_B, LISTING_C):
+        main.remember_processed_url(url)
+    assert list(main._PROCESSED_URLS) == [LISTING_B, LISTING_C]
+
+    main.save_processed_urls(path)
+    monkeypatch.setattr(main, "_PROCESSED_URLS", {})
+    main.load_processed_urls(path)
+    assert list(main._PROCESSED_URLS) == [LISTING_B, LISTING_C]
+
+
+def test_processed_urls_expire_after_ttl(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "_PROCESSED_URLS", {LISTING_A: 0.0})
+    assert not main.is_processed_url(LISTING_A)
+    main.remember_processed_url(LISTING_B)
+    assert main.is_processed_url(LISTING_B)
+
+    path = tmp_path / "processed_urls.json"
+    path.write_bytes(main.orjson.dumps({LISTING_A: 0.0, LISTING_B: main.time.time()}))
+    monkeypatch.setattr(main, "_PROCESSED_URLS", {})
+    main.load_processed_urls(str(path))
+    assert list(main._PROCESSED_URLS) == [LISTING_B]
+
+    # Files from before timestamps were stored are a plain URL list
+    path.write_bytes(main.orjson.dumps([LISTING_A, LISTING_C]))
+    monkeypatch.setattr(main, "_PROCESSED_URLS", {})
+    main.load_processed_urls(str(path))
+    assert main.is_processed_url(LISTING_A) and main.is_processed_url(LISTING_C)
+
+
+def _b64(text):
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def test_decode_body_handles_unpadded_base64url_str():
+    for text in ("a", "ab", "abc", "<a href='x?y=1'>ø</a>"):
+        assert main._decode_body(_b64(text)) == text
+
+
+def test_message_html_finds_nested_html_part():
+    msg = {"payload": {"mimeType": "multipart/mixed", "parts": [
+        {"mimeType": "multipart/alternative", "parts": [
+            {"mimeType": "text/plain", "body": {"data": _b64("plain")}},
+            {"mimeType": "text/html", "body": {"data": _b64("<p>æøå</p>")}},
+        ]},
+    ]}}
+    assert main._message_html(msg) == "<p>æøå</p>"
+
+
+def test_message_html_without_html_part():
+    msg = {"payload": {"mimeType": "text/plain", "body": {"data": _b64("plain")}}}
+    assert main._message_html(msg) is None
+
+
+def test_message_html_tolerates_missing_fields():
+    assert main._message_html({}) is None
+    assert main._message_html({"payload": {"parts": [{"body": {}}]}}) is None
+
+
+def test_block_keywords_match_detail_texts():
+    block_re = main.compile_block_keywords("deleværelse, Kun kvinder")
+    assert main.page_contains_block_keywords(["Type Værelse", "KUN KVINDER"], block_re) == (True, "kun kvinder")
+    assert main.page_contains_block_keywords(["2100 København Ø"], block_re) == (False, None)
+    assert main.page_contains_block_keywords(["kun kvinder"], None) == (False, None)
+
+
+def test_block_keywords_prefer_longest_overlapping_keyword():
+    block_re = main.compile_block_keywords("dele, deleværelse, dele")
+    assert main.page_contains_block_keywords(["Deleværelse i Valby"], block_re) == (True, "deleværelse")
+    assert main.page_contains_block_keywords(["Dele lejlighed"], block_re) == (True, "dele")
+
+
+def test_address_from_details_slices_first_zip_text():
+    details = ["Lejlighed, 60 m²", "Hovedgaden 12\n2100 København Ø", "3000 Helsingør"]
+    assert main.address_from_details(details) == "2100 København Ø"
+    assert main.address_from_details(["Pris 12345 kr.", "Ingen adresse"]) is None
+    assert main.address_from_details([]) is None
+
+
+def test_load_cookies_parses_once_and_normalises_same_site(monkeypatch):
+    raw = b'[{"name": "s", "value": "1", "sameSite": "no_restriction"}, {"name": "t", "value": "2", "sameSite": "Strict"}]'
+    monkeypatch.setattr(main, "COOKIES_JSON", raw)
+    main._load_cookies.cache_clear()
+    try:
+        cookies = main._load_cookies()
+        assert [c["sameSite"] for c in cookies] == ["Lax", "Strict"]
+        monkeypatch.setattr(main, "COOKIES_JSON", b"not json")
+        assert main._load_cookies() is cookies
+    finally:
+        main._load_cookies.cache_clear()
+
+
+def test_has_new_unread_messages_uses_history_and_resyncs_on_404():
+    http = HttpMockSequence([
+        ({"status": "200"}, '{"historyId": "105"}'),
+        ({"status": "200"}, '{"history": [{"id": "106"}], "historyId": "107"}'),
+        ({"status": "404"}, '{"error": {"code": 404, "message": "Requested entity was not found."}}'),
+        ({"status": "200"}, '{"historyId": "200"}'),
+    ])
+    service = build("gmail", "v1", http=http, static_discovery=True)
+    assert main.has_new_unread_messages(service, "100") == (False, "105")
+    assert main.has_new_unread_messages(service, "105") == (True, "107")
+    assert main.has_new_unread_messages(service, "1") == (True, "200")
+
+
+def _batch_part(msg_id, status, body):
+    return (
+        f"--BATCH\r\nContent-Type: application/http\r\nContent-ID: <response-x + {msg_id}>\r\n\r\n"
+        f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n\r\n{body}\r\n"
+    )
+
+
+def test_fetch_messages_html_uses_one_batch_request():
+    ok = main.orjson.dumps({"payload": {"mimeType": "text/html", "body": {"data": _b64("<p>1</p>")}}}).decode()
+    content = _batch_part("m1", "200 OK", ok) + _batch_part("m2", "404 Not Found", '{"error": {"code": 404}}') + "--BATCH--"
+    # A single mocked response: a second HTTP call would fail the test
+    http = HttpMockSequence([({"status": "200", "content-type": "multipart/mixed; boundary=BATCH"}, content)])
+    service = build("gmail", "v1", http=http, static_discovery=True)
+    assert main.fetch_messages_html(service, ["m1", "m2"]) == {"m1": "<p>1</p>", "m2": None}
+
+
+LISTING_PAGE_HTML = """<html><body>
+<span class="css-v34a4n">2 room apartment of 60 m²</span>
+<div class="css-o9y6d5 extra"><span>Lejlighed</span> <b>Kun kvinder</b></div>
+<div class="css-o9y6d5">Hovedgaden 12, 2100 København Ø</div>
+<div class="css-1o5zkyw">Lejeperiode 1-3 måneder</div>
+</body></html>"""
+
+
+class _FakeResponse:
+    def __init__(self, content, status=200):
+        self.content = content.encode("utf-8")
+        self.status = status
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise main.requests.HTTPError(str(self.status))
+
+
+class _FakeSession:
+    def __init__(self, response):
+        self.response = response
+
+    def get(self, url, timeout=None):
+        return self.response
+
+
+def test_fetch_listing_snapshot_reads_server_rendered_divs(monkeypatch):
+    monkeypatch.setattr(main, "_listing_http_session", lambda: _FakeSession(_FakeResponse(LISTING_PAGE_HTML)))
+    snapshot = main.fetch_listing_snapshot(LISTING_A)
+    assert snapshot == {
+        "details": ["Lejlighed Kun kvinder", "Hovedgaden 12, 2100 København Ø"],
+        "terms": ["Lejeperiode 1-3 måneder", ""],
+    }
+
+
+def test_fetch_listing_snapshot_falls_back_without_detail_divs(monkeypatch):
+    monkeypatch.setattr(main, "_listing_http_session", lambda: _FakeSession(_FakeResponse("<div id=root></div>")))
+    assert main.fetch_listing_snapshot(LISTING_A) is None
+    monkeypatch.setattr(main, "_listing_http_session", lambda: _FakeSession(_FakeResponse("", status=503)))
+    assert main.fetch_listing_snapshot(LISTING_A) is None
+
+
+def test_prefilter_listing_skips_blocked_and_short_term(monkeypatch):
+    sent = []
+    monkeypatch.setattr(main, "notify_discord", lambda *args, **kwargs: sent.append(args))
+    monkeypatch.setattr(main, "_listing_http_session", lambda: _FakeSession(_FakeResponse(LISTING_PAGE_HTML)))
+
+    assert asyncio.run(main.prefilter_listing(LISTING_A, main.compile_block_keywords("kun kvinder")))
+    assert asyncio.run(main.prefilter_listing(LISTING_A, None))
+    assert [args[0] for args in sent] == ["blocked", "short_term"]
+
+    page = LISTING_PAGE_HTML.replace("Lejeperiode 1-3 måneder", "Lejeperiode Ubegrænset")
+    monkeypatch.setattr(main, "_listing_http_session", lambda: _FakeSession(_FakeResponse(page)))
+    assert not asyncio.run(main.prefilter_listing(LISTING_A, None))
+
+
+def test_prefilter_listing_falls_through_to_the_browser_when_slow(monkeypatch):
+    sent = []
+    monkeypatch.setattr(main, "notify_discord", lambda *args, **kwargs: sent.append(args))
+    monkeypatch.setattr(main, "LISTING_HTTP_TIMEOUT_SECONDS", 0.01)
+
+    def _slow(url):
+        time.sleep(0.2)
+        return {"details": ["Kun kvinder"], "terms": ["", ""]}
+
+    monkeypatch.setattr(main, "fetch_listing_snapshot", _slow)
+    assert not asyncio.run(main.prefilter_listing(LISTING_A, main.compile_block_keywords("kun kvinder")))
+    assert sent == []
+
+
+def test_prefiltered_listings_never_launch_the_browser(monkeypatch):
+    monkeypatch.setattr(main, "notify_discord", lambda *args, **kwargs: None)
+    monkeypatch.setattr(main, "_listing_http_session", lambda: _FakeSession(_FakeResponse(LISTING_PAGE_HTML)))
+    monkeypatch.setattr(main, "_PROCESSED_URLS", {})
+
+    async def _get_context():
+        raise AssertionError("browser launched")
+
+    asyncio.run(main.process_listings(_get_context, [LISTING_A, LISTING_B], "hi", None))
+    assert list(main._PROCESSED_URLS) == [LISTING_A, LISTING_B]
+
+
+def test_token_needs_refresh_only_near_expiry():
+    now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+    assert not main._token_needs_refresh(Credentials("t", expiry=now_utc + timedelta(minutes=30)))
+    assert main._token_needs_refresh(Credentials("t", expiry=now_utc + timedelta(minutes=2)))
+    assert main._token_needs_refresh(Credentials(None, refresh_token="r"))
+
+
+def test_logged_out_saved_session_is_retried_with_the_cookies(monkeypatch):
+    sent = []
+    monkeypatch.setattr(main, "notify_discord", lambda *args, **kwargs: sent.append(args[0]))
+    monkeypatch.setattr(main, "LISTING_HTTP_PREFILTER", False)
+
+    class _FakeContext:
+        def __init__(self, logged_in):
+            self.logged_in, self.pages, self.closed = logged_in, [], False
+
+        async def close(self):
+            self.closed = True
+
+    async def _visit(context, url, message_text, block_re):
+        return True if context.logged_in else None
+
+    monkeypatch.setattr(main, "visit_listing", _visit)
+    stale, fresh = _FakeContext(False), _FakeContext(True)
+
+    async def _get_context(replace=None):
+        return fresh if replace is stale else stale
+
+    assert asyncio.run(main.process_listing(_get_context, LISTING_A, "hi", None))
+    assert stale.closed and sent == []
+
+    async def _no_replacement(replace=None):
+        return None if replace is stale else stale
+
+    stale.closed = False
+    assert not asyncio.run(main.process_listing(_no_replacement, LISTING_A, "hi", None))
+    assert not stale.closed and sent == ["expired_session"]
+
+
+def test_process_new_emails_once_leaves_emails_unread_when_fetch_fails(monkeypatch):
+    marked = []
+    monkeypatch.setattr(main, "list_unread_boligportal_messages", lambda service, sender: [{"id": "m1"}, {"id": "m2"}])
+    monkeypatch.setattr(main, "mark_messages_read", lambda service, ids: marked.append(ids))
+
+    def _timeout(service, msg_ids):
+        raise TimeoutError("timed out")
+
+    monkeypatch.setattr(main, "fetch_messages_html", _timeout)
+    assert not asyncio.run(main.process_new_emails_once(None, None, "x", "hi", None))
+    assert marked == []
+
+
+def test_process_new_emails_once_asks_for_another_search_after_a_full_page(monkeypatch):
+    marked = []
+    page = [{"id": f"m{i}"} for i in range(main.GMAIL_LIST_PAGE_SIZE)]
+    monkeypatch.setattr(main, "mark_messages_read", lambda service, ids: marked.append(ids))
+    monkeypatch.setattr(main, "fetch_messages_html", lambda service, msg_ids: dict.fromkeys(msg_ids))
+
+    # A full page: older unread emails the history API won't report may remain
+    monkeypatch.setattr(main, "list_unread_boligportal_messages", lambda service, sender: page)
+    assert not asyncio.run(main.process_new_emails_once(None, None, "x", "hi", None))
+    # The rest of the backlog: the history API can take over again
+    monkeypatch.setattr(main, "list_unread_boligportal_messages", lambda service, sender: page[:3])
+    assert asyncio.run(main.process_new_emails_once(None, None, "x", "hi", None))
+    assert [len(ids) for ids in marked] == [main.GMAIL_LIST_PAGE_SIZE, 3]
+
+
+def test_process_new_emails_once_saves_handled_urls_after_each_batch(monkeypatch):
+    saved = []
+    monkeypatch.setattr(main, "_PROCESSED_URLS", {})
+    monkeypatch.setattr(main, "save_processed_urls", lambda: saved.append(list(main._PROCESSED_URLS)))
+    monkeypatch.setattr(main, "list_unread_boligportal_messages", lambda service, sender: [{"id": "m1"}])
+    monkeypatch.setattr(main, "fetch_messages_html", lambda service, msg_ids: {"m1": EMAIL_HTML})
+    monkeypatch.setattr(main, "mark_messages_read", lambda service, ids: None)
+
+    async def _handle(get_context, urls, message_text, block_re):
+        for url in urls:
+            main.remember_processed_url(url)
+
+    monkeypatch.setattr(main, "process_listings", _handle)
+    asyncio.run(main.process_new_emails_once(None, None, "x", "hi", None))
+    assert saved == [[LISTING_A, LISTING_B, LISTING_C]]
+
+    # Nothing new handled: no write
+    asyncio.run(main.process_new_emails_once(None, None, "x", "hi", None))
+    assert len(saved) == 1
+
+
+class _FakeButtons:
+    """Buttons (accessible name, text) in DOM order, queried like Playwright locators."""
+
+    def __init__(self, buttons, matches=None):
+        self.buttons = buttons
+        self.matches = matches or (lambda button: False)
+
+    def get_by_role(self, role, name):
+        return _FakeButtons(self.buttons, lambda button: bool(name.search(button[0])))
+
+    def locator(self, selector):
+        texts = {part.split("'")[1] for part in selector.split(", ")}
+        return _FakeButtons(self.buttons, lambda button: button[1] in texts)
+
+    def or_(self, other):
+        return _FakeButtons(self.buttons, lambda button: self.matches(button) or other.matches(button))
+
+    @property
+    def first(self):
+        found = [button for button in self.buttons if self.matches(button)][:1]
+        return _FakeButtons(self.buttons, lambda button: button in found)
+
+    async def count(self):
+        return sum(1 for button in self.buttons if self.matches(button))
+
+    async def wait_for(self):
+        assert await self.count()
+
+
+def test_contact_button_skips_contact_us_and_inbox_buttons():
+    async def _resolve(buttons):
+        button = await main.contact_button(_FakeButtons(buttons))
+        return [b for b in buttons if button.matches(b)]
+
+    header = [("Kontakt os", "Kontakt os"), ("Gå til beskeder", "Gå til beskeder")]
+    real = ("Kontakt udlejer", "Kontakt")
+    assert asyncio.run(_resolve(header + [real])) == [real]
+    assert asyncio.run(_resolve(header)) == [("Gå til beskeder", "Gå til beskeder")]
+
+
+def test_gmail_push_pull_failure_falls_back_to_polling():
+    from google.api_core.exceptions import DeadlineExceeded, ServiceUnavailable
+
+    class _Subscriber:
+        def __init__(self, exc):
+            self.exc = exc
+
+        def pull(self, **kwargs):
+            raise self.exc
+
+    assert main.wait_for_gmail_push(_Subscriber(ServiceUnavailable("down")), 1) is None
+    assert main.wait_for_gmail_push(_Subscriber(DeadlineExceeded("idle")), 1) is False
@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pytest
+
 from src.term_detector import is_short_term_heuristic
 
 textWithShortTerm = ["Well-maintained 2-room apartment located in the heart of Inner Østerbro, available for rent for an 11-month lease starting 15.09.25 (and ending 15.08.2026)",
@@ -37,3 +41,169 @@ def test_not_find_terms_in_text_with_no_terms():
         result = is_short_term_heuristic(t, months_threshold=16)
         print(f"Text {i}: {result}")
         #assert not result["is_short_term"], f"Expected is_short_term False for text {i}, got {result['is_short_term']}"
+
+
+def test_uppercase_ordinal_dates_form_a_range():
+    result = is_short_term_heuristic("AVAILABLE FROM 1ST OCTOBER TO 2ND NOVEMBER 2025", months_threshold=6)
+    assert result["is_short_term"] and result["end_date"].startswith("2025-11-02")
+
+
+def test_day_month_year_date_is_read_once():
+    # "september 2025" inside "1. september 2025" is not a second date (the 28th)
+    result = is_short_term_heuristic("i perioden 1. september 2025 - 1. marts 2026", months_threshold=6)
+    assert result["is_short_term"] and result["end_date"] == "2026-03-01"
+
+
+def test_dates_without_year_use_the_year_of_now():
+    result = is_short_term_heuristic("indtil 1. december", months_threshold=6, now=datetime(2030, 9, 1))
+    assert result["end_date"] == "2030-12-01"
+
+
+def test_mixed_separator_dates_form_a_range():
+    result = is_short_term_heuristic("ledigt fra 1/8-2025 til 1/2-2026", months_threshold=8)
+    assert result["is_short_term"] and result["confidence"] == "high"
+    assert result["end_date"] == "2026-02-01"
+
+
+def test_price_next_to_a_mixed_separator_end_date():
+    result = is_short_term_heuristic("Husleje 8.303 pr. mdr. indtil 1/10-2026", months_threshold=6, now=datetime(2026, 5, 1))
+    assert result["is_short_term"] and result["end_date"] == "2026-10-01"
+
+
+def test_cached_result_is_not_shared_between_calls():
+    first = is_short_term_heuristic("indtil 1. december 2030", months_threshold=6, now=datetime(2030, 9, 1))
+    first["is_short_term"] = None
+    again = is_short_term_heuristic("indtil 1. december 2030", months_threshold=6, now=datetime(2030, 9, 1))
+    later = is_short_term_heuristic("indtil 1. december 2030", months_threshold=6, now=datetime(2030, 11, 1))
+    assert again["is_short_term"] is True
+    assert again["reason"] != later["reason"]
+
+
+def test_year_inference_skips_a_leap_day_missing_from_the_other_year():
+    result = is_short_term_heuristic("fra 29. februar til 1. marts 2027", months_threshold=6, now=datetime(2028, 1, 1))
+    assert not result["is_short_term"]
+
+
+def test_deposit_months_do_not_override_the_lease_length():
+    result = is_short_term_heuristic("3 mdr. depositum. Lejeperiode 24 months", months_threshold=8)
+    assert not result["is_short_term"] and result["confidence"] == "low"
+
+
+def test_range_of_exactly_the_threshold_counts_as_short_term():
+    result = is_short_term_heuristic("i perioden 1. august 2025 - 1. februar 2026", months_threshold=6)
+    assert result["is_short_term"] and result["confidence"] == "high"
+
+
+# Baseline decisions (is_short_term, confidence) at the bot's threshold (8) and a
+# tighter one, so a change to the patterns or date logic shows up as a failure
+TERM_CASES_NOW = datetime(2025, 8, 15)
+TERM_CASES = [
+    ('Udlejes i 3 uger fra 1. juli', 6, True, 'high'),
+    ('Udlejes i 3 uger fra 1. juli', 8, True, 'high'),
+    ('Sublet for 10 weeks', 6, True, 'high'),
+    ('Sublet for 10 weeks', 8, True, 'high'),
+    ('lease for 4-months', 6, True, 'high'),
+    ('lease for 4-months', 8, True, 'high'),
+    ('2 mos only', 6, True, 'high'),
+    ('2 mos only', 8, True, 'high'),
+    ('12 mths', 6, False, 'low'),
+    ('12 mths', 8, False, 'low'),
+    ('fra 2025-09-01 til 2026-02-28', 6, True, 'high'),
+    ('fra 2025-09-01 til 2026-02-28', 8, True, 'high'),
+    ('from 2025-09-01 until 2025-12-01', 6, True, 'high'),
+    ('from 2025-09-01 until 2025-12-01', 8, True, 'high'),
+    ('Available 01/09/2025 - 31/12/2025', 6, True, 'high'),
+    ('Available 01/09/2025 - 31/12/2025', 8, True, 'high'),
+    ('ledigt fra 1. august', 6, False, 'med'),
+    ('ledigt fra 1. august', 8, False, 'med'),
+    ('indtil 31. december 2025', 6, True, 'med'),
+    ('indtil 31. december 2025', 8, True, 'med'),
+    ('until March 2026', 6, False, 'med'),
+    ('until March 2026', 8, True, 'med'),
+    ('ends 12/31/2025', 6, True, 'med'),
+    ('ends 12/31/2025', 8, True, 'med'),
+    ('senest 1.3.26', 6, False, 'med'),
+    ('senest 1.3.26', 8, True, 'med'),
+    ('Fremleje af værelse', 6, True, 'low'),
+    ('Fremleje af værelse', 8, True, 'low'),
+    ('midlertidigt udlejes, bindingsperiode 6 mdr', 6, False, 'high'),
+    ('midlertidigt udlejes, bindingsperiode 6 mdr', 8, False, 'high'),
+    ('binding 3 måneder', 6, False, 'high'),
+    ('binding 3 måneder', 8, False, 'high'),
+    ('September 2nd to October 20th', 6, True, 'high'),
+    ('September 2nd to October 20th', 8, True, 'high'),
+    ('1st Oct or 1st Nov 2025', 6, False, 'low'),
+    ('1st Oct or 1st Nov 2025', 8, False, 'low'),
+    ('from 5 jan to 20 feb', 6, True, 'high'),
+    ('from 5 jan to 20 feb', 8, True, 'high'),
+    ('perioden 1/8 2025 15/1 2026', 6, False, 'low'),
+    ('perioden 1/8 2025 15/1 2026', 8, False, 'low'),
+    ('i perioden juni 2025 1 oktober 2025', 6, True, 'high'),
+    ('i perioden juni 2025 1 oktober 2025', 8, True, 'high'),
+    ('Available from October 1st, 2025 through January 31st 2026', 6, True, 'high'),
+    ('Available from October 1st, 2025 through January 31st 2026', 8, True, 'high'),
+    ('Lejlighed 8.303 pr. mdr. ledig', 6, False, 'low'),
+    ('Lejlighed 8.303 pr. mdr. ledig', 8, False, 'low'),
+    ('udløber 30.06.2027', 6, False, 'med'),
+    ('udløber 30.06.2027', 8, False, 'med'),
+    ('korttids leje 1.5.2026', 6, True, 'low'),
+    ('korttids leje 1.5.2026', 8, True, 'low'),
+    ('temporary — 15. maj - 15. juni', 6, True, 'high'),
+    ('temporary — 15. maj - 15. juni', 8, True, 'high'),
+    ('', 6, False, 'low'),
+    ('', 8, False, 'low'),
+    ('   ', 6, False, 'low'),
+    ('   ', 8, False, 'low'),
+    ('no numbers here at all', 6, False, 'low'),
+    ('no numbers here at all', 8, False, 'low'),
+    ('31.02.2025 til 1.3.2025', 6, False, 'low'),
+    ('31.02.2025 til 1.3.2025', 8, False, 'low'),
+    ('13/25/2025 - 01/01/2026', 6, False, 'low'),
+    ('13/25/2025 - 01/01/2026', 8, False, 'low'),
+    ('2025-13-01 fra', 6, False, 'low'),
+    ('2025-13-01 fra', 8, False, 'low'),
+    ('Maj 2026 til juni 2026', 6, True, 'high'),
+    ('Maj 2026 til juni 2026', 8, True, 'high'),
+    ('dec 2025 - jan 2026', 6, True, 'high'),
+    ('dec 2025 - jan 2026', 8, True, 'high'),
+    ('Mar 3 2026 until Apr 4 2026', 6, True, 'high'),
+    ('Mar 3 2026 until Apr 4 2026', 8, True, 'high'),
+    ('3rd March to 4th April', 6, True, 'high'),
+    ('3rd March to 4th April', 8, True, 'high'),
+    ('fra 1. juli eller 1. august til 1. september', 6, True, 'high'),
+    ('fra 1. juli eller 1. august til 1. september', 8, True, 'high'),
+    ('Lejeperiode 1-3 måneder', 6, True, 'high'),
+    ('Lejeperiode 1-3 måneder', 8, True, 'high'),
+    ('Lejeperiode Ubegrænset', 6, False, 'low'),
+    ('Lejeperiode Ubegrænset', 8, False, 'low'),
+    ('Ledig fra 01.10.2025 Lejeperiode 6-12 måneder', 6, False, 'low'),
+    ('Ledig fra 01.10.2025 Lejeperiode 6-12 måneder', 8, False, 'low'),
+    ('udlejes 24 mdr', 6, False, 'low'),
+    ('udlejes 24 mdr', 8, False, 'low'),
+    ('20 uger', 6, True, 'high'),
+    ('20 uger', 8, True, 'high'),
+    ('Jan 2026', 6, False, 'low'),
+    ('Jan 2026', 8, False, 'low'),
+    ('Fra 1. september 2025 til 1. august 2026 - binding 12 måneder', 6, False, 'high'),
+    ('Fra 1. september 2025 til 1. august 2026 - binding 12 måneder', 8, False, 'high'),
+    ('AVAILABLE 1.9.25-1.12.25', 6, True, 'high'),
+    ('AVAILABLE 1.9.25-1.12.25', 8, True, 'high'),
+    ('1.9-25', 6, False, 'low'),
+    ('1.9-25', 8, False, 'low'),
+    ('Tidsbegrænset: 01-09-2025 – 28-02-2026', 6, True, 'high'),
+    ('Tidsbegrænset: 01-09-2025 – 28-02-2026', 8, True, 'high'),
+    ('start 2025-10-01', 6, False, 'low'),
+    ('start 2025-10-01', 8, False, 'low'),
+    ('Sublet: Oct 2025 to Feb 2026 (or longer)', 6, True, 'high'),
+    ('Sublet: Oct 2025 to Feb 2026 (or longer)', 8, True, 'high'),
+    ('3 mdr. depositum. Lejeperiode 24 months', 6, False, 'low'),
+    ('3 mdr. depositum. Lejeperiode 24 months', 8, False, 'low'),
+    ('ledigt fra 1/8-2025 til 1/2-2026', 6, True, 'high'),
+    ('ledigt fra 1/8-2025 til 1/2-2026', 8, True, 'high'),
+]
+
+
+@pytest.mark.parametrize("text, threshold, short_term, confidence", TERM_CASES)
+def test_term_cases_keep_their_decision(text, threshold, short_term, confidence):
+    result = is_short_term_heuristic(text, months_threshold=threshold, now=TERM_CASES_NOW)
+    assert (result["is_short_term"], result["confidence"]) == (short_term, confidence)